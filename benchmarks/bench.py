@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Benchmark the cleaning pipeline on the synthetic reference corpus.
+
+For every kind of page this times parse() end to end, every stage of clean()
+ on its own, a single unescape() call and compact(), and reports pages/s,
+ MB/s and peak memory.  Results can be written as JSON and compared with a
+ previous run, e.g. one made on another commit or interpreter:
+
+    python benchmarks/bench.py --output before.json
+    ... change things ...
+    python benchmarks/bench.py --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import KINDS, make_corpus
+from wikimedia2text.parser import clean_stages, compact, parse, unescape
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+def best_of(repeat, func, *args):
+    """Smallest wall time of repeat calls of func"""
+    best = None
+    for _ in range(repeat):
+        started = timer()
+        func(*args)
+        elapsed = timer() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def parse_all(pages):
+    for page in pages:
+        parse(page)
+
+
+def peak_memory(pages):
+    """Peak memory allocated while parsing the pages one by one, in KB"""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        parse_all(pages)
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def time_stages(texts, repeat):
+    """Time each stage of clean() on the output of the previous one, then unescape() and compact()"""
+    stages = {}
+    for name, stage in clean_stages:
+        stages[name] = best_of(repeat, lambda: [stage(text, False, None)[0] for text in texts])
+        if name == 'unescape':
+            unescape_once = best_of(repeat, lambda: [unescape(text) for text in texts])
+        texts = [stage(text, False, None)[0] for text in texts]
+    compacting = best_of(repeat, lambda: [compact(text) for text in texts])
+    return stages, unescape_once, compacting
+
+
+def run(pages, repeat, kinds):
+    corpus = make_corpus(pages, kinds=kinds)
+    results = {}
+    for kind in kinds:
+        texts = corpus[kind]
+        encoded = [text.encode('utf-8') for text in texts]
+        size = sum(len(page) for page in encoded)
+        elapsed = best_of(repeat, parse_all, encoded)
+        stages, unescape_once, compacting = time_stages(texts, repeat)
+        results[kind] = {
+            'pages': len(texts),
+            'bytes': size,
+            'parse': {
+                'seconds': elapsed,
+                'pages_per_s': len(texts) / elapsed,
+                'mb_per_s': size / elapsed / 1e6,
+            },
+            'stages': stages,
+            'unescape': unescape_once,
+            'compact': compacting,
+            'peak_kb': peak_memory(encoded),
+        }
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'corpus': {'pages': pages, 'kinds': list(kinds)},
+        'repeat': repeat,
+        'results': results,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def report(data, out=sys.stdout):
+    out.write('Python %s (%s), %d pages per kind, best of %d\n' % (
+        data['python'], data['implementation'], data['corpus']['pages'], data['repeat']))
+    stage_names = [name for name, stage in clean_stages]
+    out.write('%-10s %10s %8s %9s  %s\n' % ('kind', 'pages/s', 'MB/s', 'peak KB', 'ms per stage: ' + ' '.join(stage_names) + ' compact'))
+    for kind in data['corpus']['kinds']:
+        r = data['results'][kind]
+        timings = ' '.join('%.1f' % (r['stages'][name] * 1000) for name in stage_names)
+        out.write('%-10s %10.1f %8.2f %9s  %s %.1f\n' % (
+            kind, r['parse']['pages_per_s'], r['parse']['mb_per_s'],
+            r['peak_kb'] if r['peak_kb'] is not None else '-', timings, r['compact'] * 1000))
+    out.write('max RSS %d KB\n' % data['max_rss_kb'])
+
+
+def compare(data, baseline, out=sys.stdout):
+    """Speedup of data over baseline, as baseline time / current time (> 1 is faster)"""
+    out.write('Speedup over Python %s (%s):\n' % (baseline['python'], baseline['implementation']))
+    for kind in data['corpus']['kinds']:
+        if kind not in baseline['results']:
+            continue
+        r, b = data['results'][kind], baseline['results'][kind]
+        parts = ['parse x%.2f' % (b['parse']['seconds'] / r['parse']['seconds'])]
+        for name in sorted(r['stages']):
+            if name in b['stages'] and r['stages'][name]:
+                parts.append('%s x%.2f' % (name, b['stages'][name] / r['stages'][name]))
+        parts.append('compact x%.2f' % (b['compact'] / r['compact']))
+        out.write('%-10s %s\n' % (kind, ', '.join(parts)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--pages', type=int, default=50, help='pages of each kind (default: 50)')
+    parser.add_argument('--repeat', type=int, default=3, help='keep the best of REPEAT runs (default: 3)')
+    parser.add_argument('--kinds', nargs='+', choices=KINDS, default=list(KINDS))
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    data = run(args.pages, args.repeat, args.kinds)
+    report(data)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(data, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
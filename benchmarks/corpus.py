@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic reference corpus for the benchmarks.
+
+Pages are generated from a fixed seed, so every run and every interpreter
+ sees exactly the same text.  Each kind stresses a different part of clean():
+
+    small           stubs of a few sentences
+    typical         a mid-sized article with references, links and sections
+    templates       infobox and navbox heavy article, nested templates
+    tables          wikitables and html tables
+    math            physics/maths article full of <math> and <code> blocks
+"""
+import random
+
+KINDS = ('small', 'typical', 'templates', 'tables', 'math')
+
+_WORDS = (u'the of and in to a is was for on as by with from that at his an are which '
+          u'anarchism state society political philosophy movement theory history century '
+          u'government war city river population music album species university café '
+          u'naïve Zürich São Paulo Kraków Ελλάδα 東京').split()
+
+
+class _Random(random.Random):
+    """choice() and randint() built on random() alone, so Python 2 and 3 draw the same pages"""
+
+    def randint(self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.random() * len(seq))]
+
+
+def _sentence(rng, words=12):
+    text = u' '.join(rng.choice(_WORDS) for _ in range(rng.randint(words // 2, words)))
+    return text[0].upper() + text[1:] + u'.'
+
+
+def _link(rng):
+    target = rng.choice(_WORDS)
+    r = rng.random()
+    if r < 0.5:
+        return u'[[%s]]' % target
+    if r < 0.8:
+        return u'[[%s|%s]]' % (target, rng.choice(_WORDS))
+    if r < 0.9:
+        return u'[[%s]]s' % target
+    return u'[[wikt:%s|%s]]' % (target, target)
+
+
+def _ref(rng):
+    r = rng.random()
+    if r < 0.4:
+        return u'&lt;ref&gt;{{cite book |last=%s |title=%s |year=%d}}&lt;/ref&gt;' % (
+            rng.choice(_WORDS), _sentence(rng, 4), rng.randint(1800, 2014))
+    if r < 0.7:
+        return u'&lt;ref name=&quot;%s%d&quot;/&gt;' % (rng.choice(_WORDS), rng.randint(1, 9))
+    return u'&lt;ref&gt;[http://www.example.org/%d %s]&lt;/ref&gt;' % (rng.randint(1, 10 ** 6), _sentence(rng, 5))
+
+
+def _paragraph(rng, sentences=5):
+    out = []
+    for _ in range(sentences):
+        s = _sentence(rng)
+        words = s.split(u' ')
+        for _ in range(rng.randint(0, 3)):
+            words.insert(rng.randint(0, len(words)), _link(rng))
+        if rng.random() < 0.3:
+            words.insert(rng.randint(0, len(words)), u"'''%s'''" % rng.choice(_WORDS))
+        if rng.random() < 0.3:
+            words.insert(rng.randint(0, len(words)), u"''%s''" % rng.choice(_WORDS))
+        if rng.random() < 0.4:
+            words.append(_ref(rng))
+        out.append(u' '.join(words))
+    return u' '.join(out) + u'\n'
+
+
+def _template(rng, depth=0):
+    params = []
+    for i in range(rng.randint(2, 8)):
+        value = _sentence(rng, 4)
+        if depth < 3 and rng.random() < 0.3:
+            value = _template(rng, depth + 1)
+        params.append(u'| %s%d = %s' % (rng.choice(_WORDS), i, value))
+    return u'{{%s\n%s\n}}' % (rng.choice(_WORDS), u'\n'.join(params))
+
+
+def _wikitable(rng):
+    rows = [u'{| class="wikitable"', u'! %s !! %s !! %s' % tuple(rng.choice(_WORDS) for _ in range(3))]
+    for _ in range(rng.randint(3, 15)):
+        rows.append(u'|-')
+        rows.append(u'| %s || %s || {{flag|%s}}' % (rng.choice(_WORDS), rng.randint(1, 10 ** 5), rng.choice(_WORDS)))
+    rows.append(u'|}')
+    return u'\n'.join(rows) + u'\n'
+
+
+def _htmltable(rng):
+    cells = u''.join(u'&lt;tr&gt;&lt;td&gt;%s&lt;/td&gt;&lt;td&gt;%d&lt;/td&gt;&lt;/tr&gt;' % (
+        rng.choice(_WORDS), rng.randint(1, 100)) for _ in range(rng.randint(2, 10)))
+    return u'&lt;table&gt;%s&lt;/table&gt;\n' % cells
+
+
+def _math(rng):
+    r = rng.random()
+    if r < 0.7:
+        return u'&lt;math&gt;\\frac{%s_{%d}}{%d} = \\sum_{i=0}^{n} x_i^%d&lt;/math&gt;' % (
+            rng.choice(u'abcxyz'), rng.randint(0, 9), rng.randint(1, 99), rng.randint(2, 5))
+    return u'&lt;code&gt;f(%d) = g(x) + %d&lt;/code&gt;' % (rng.randint(0, 99), rng.randint(0, 99))
+
+
+def _sections(rng, count, body):
+    out = []
+    for i in range(count):
+        out.append(u'\n==%s==\n' % _sentence(rng, 3)[:-1])
+        if rng.random() < 0.3:
+            out.append(u'===%s===\n' % _sentence(rng, 2)[:-1])
+        out.append(body(rng))
+        if rng.random() < 0.3:
+            out.append(u'* %s\n* %s\n' % (_sentence(rng, 5), _sentence(rng, 5)))
+    return u''.join(out)
+
+
+def make_page(kind, rng):
+    """Build one page of the given kind"""
+    if kind == 'small':
+        return _paragraph(rng, rng.randint(1, 3)) + u'\n[[Category:%s]]\n' % rng.choice(_WORDS)
+    if kind == 'typical':
+        head = u'{{Use dmy dates|date=May 2014}}\n' + _paragraph(rng, 6)
+        return head + _sections(rng, rng.randint(3, 8), lambda r: _paragraph(r, r.randint(3, 8)))
+    if kind == 'templates':
+        head = u'\n'.join(_template(rng) for _ in range(rng.randint(3, 8))) + u'\n' + _paragraph(rng, 3)
+        body = lambda r: _template(r) + u'\n' + _paragraph(r, 3)
+        tail = u'\n'.join(_template(rng) for _ in range(rng.randint(5, 15)))
+        return head + _sections(rng, rng.randint(3, 6), body) + u'\n' + tail
+    if kind == 'tables':
+        body = lambda r: _paragraph(r, 2) + _wikitable(r) + _htmltable(r)
+        return _paragraph(rng, 3) + _sections(rng, rng.randint(3, 8), body)
+    if kind == 'math':
+        def body(r):
+            text = _paragraph(r, 2)
+            for _ in range(r.randint(5, 20)):
+                text += u'%s %s\n' % (_sentence(r, 6), _math(r))
+            return text
+        return _paragraph(rng, 3) + _sections(rng, rng.randint(3, 8), body)
+    raise ValueError('unknown page kind %r' % kind)
+
+
+def make_corpus(pages=50, seed=2014, kinds=KINDS):
+    """
+    :param pages: number of pages of each kind
+    :return: a dict of kind -> list of unicode wikimedia pages
+    """
+    corpus = {}
+    for kind in kinds:
+        rng = _Random(seed * 100 + KINDS.index(kind))
+        corpus[kind] = [make_page(kind, rng) for _ in range(pages)]
+    return corpus
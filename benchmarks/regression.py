@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Regression check of the cleaning against the output of a reference parser.
+
+regression.json holds a corpus of inputs with the output the original parser
+ (the last one before the cleaning was rewritten for speed) gave for them:
+
+    templates   dropNested(dropNested(text, '{{', '}}'), '{|', '|}'), the
+                pair dropTemplatesAndTables() replaces
+    nested      dropNested(text, '{{', '}}')
+    unescape    unescape(unescape(text)), which unescapeNested() replaces
+    parse       parse(text)
+
+Run it after changing the cleaning, on Python 2 and 3; it lists the cases
+ whose output changed and exits with status 1 if any did:
+
+    python benchmarks/regression.py
+
+The expected outputs are regenerated from a reference parser.py, run by the
+ interpreter it was written for (Python 2 for the original one):
+
+    git show cf493f9:wikimedia2text/parser.py > /tmp/reference.py
+    python2 benchmarks/regression.py --expected-from /tmp/reference.py
+
+It also times clean_linear() on inputs it once took quadratic time on, which
+ must stay well under TIME_LIMIT seconds each, checks that the outputs write the
+ surrogates character references may leave as Python 2 does, that the
+ pipeline fails on batches its pool cannot run, and on Python 3 that the
+ asyncio front end fails or cancels requests cleanly.
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from corpus import _Random
+from wikimedia2text.cache import ParseCache
+from wikimedia2text.cli import encode_record
+from wikimedia2text.dump import Page
+from wikimedia2text.guard import clean_linear
+from wikimedia2text.parser import dropNested, dropTemplatesAndTables, encode_utf8, parse, unescapeNested
+from wikimedia2text.pipeline import imap_batches
+from wikimedia2text.store import StoreReader, StoreWriter
+
+
+EXPECTED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regression.json')
+
+CHECKS = ('templates', 'nested', 'unescape', 'parse')
+
+# Cases that once told a rewrite from the original, before the random ones
+FIXED_CASES = {
+    'templates': [
+        u'{{a{{b}}', u'}}{{', u'{{{|x|}}}', u'{|{{|}}|}', u'a{{b}}|}c{|d', u'{{a}}{{b}} {{c', u'{{{{a}}',
+        u'{|a|}{|b', u'{{a|}}}', u'{{|}}{|}}', u'x{{a}}|{{b}}}y', u'{{a}}{{|b|}}|}',
+    ],
+    'unescape': [
+        u'&amp;nbsp;', u'&#x0x26;lt;', u'&#x0X26;amp;', u'&#38;lt&#59;', u'&amp;amp;', u'&#38;&#38;lt;',
+        u'&amp;&#110;bsp;', u'&#1_0;', u'&#99999999;', u'&#55296;', u'&#X26;lt;',
+    ],
+    'parse': [
+        u'<math>x^2</math> a <math>\xc4\xd6:<math>x^2</math> b', u'<math>a</math> <math>a</math> <code>c</code>',
+        u'<math>a<b</math>', u'&#x0x26;lt;b&#x0x26;gt; bold', u'[[w:Paris|Paris]] [[fr:Paris]] x',
+        u"'''''a''''' ''b'' '''c'''", u'{{a|[[b]]}} c [[d|e]]s', u'<ref>a</ref> b<br/> c <!-- d --> e',
+        u'== Title ==\n* item\n text', u'{| class="t"\n| a\n|}\nb',
+        u'a <<br/>li>x<<br/>/li> b', u'<<pre>p</pre>li>', u'<<!-- c -->table>', u'<<b>gallery>',
+        u'<<pre>p</pre>li>x</li>', u'<<!-- c -->table>x</table>y', u'<<b>gallery>x</gallery>y',
+        u'<<pre>x</pre>li>y<<pre>x</pre>/li> z',
+    ],
+}
+
+# Inputs clean_linear() must clean in linear time; they take a few milliseconds
+TIMED_CASES = [
+    ('< + 40000 letters', u'<' + u'a' * 40000),
+    ('</ + 40000 letters', u'</' + u'a' * 40000),
+    ('< + 40000 words', u'<' + u'a ' * 40000),
+    ('20000 [[a', u'[[a' * 20000),
+    ('20000 <a', u'<a ' * 20000),
+]
+
+TIME_LIMIT = 1.0
+
+# Pages leaving surrogates in the text, with the utf-8 Python 2 writes for it
+SURROGATE_CASES = [
+    (u'Before &#55296; after', b'Before \xed\xa0\x80 after'),
+    (u'&#xD800;&#xDC00; &#xDC00;&#xD800;', b'\xf0\x90\x80\x80 \xed\xb0\x80\xed\xa0\x80'),
+]
+
+_DELIMITERS = [u'{{', u'}}', u'{|', u'|}', u'{', u'}', u'|', u'a', u' ', u'\n']
+
+_ENTITIES = [u'&', u'amp;', u'&amp;', u'&#38;', u'&#0038;', u'&#x26;', u'&#x0026;', u'&#X26;', u'&#x0x26;',
+             u'#', u';', u'nbsp', u'nbsp;', u'&nbsp;', u'&#35;', u'&#59;', u'&#110;', u'&#x6e;', u'x', u'lt;',
+             u'&lt;', u'&#1_0;', u'&foo;', u' ', u'\xe9', u'&amp;amp;', u'&#97;', u'_', u'&quot;', u'0']
+
+_MARKUP = [u'{{', u'}}', u'{|', u'|}', u'[[', u']]', u'|', u"'''", u"''", u'<ref>', u'</ref>', u'<b>', u'</b>',
+           u'<!--', u'-->', u'<br/>', u'<math>', u'</math>', u'<math>x^2</math>', u'&amp;', u'&lt;', u'&nbsp;',
+           u'&amp;nbsp;', u'&#x0x26;', u'word', u' ', u'\n', u'==', u'x', u'<table>', u'</table>', u'<code>',
+           u'</code>', u'[http://a.b c]', u'*', u'#', u'<td>', u'</td>', u'<ref name=a/>', u'\xc4\xd6:',
+           u'[[w:a|b]]', u'[[Category:c]]']
+
+
+def make_cases(count=600):
+    """The inputs of every check, the fixed cases followed by random ones drawn from a fixed seed"""
+    rng = _Random(20141003)
+
+    def draw(pieces, length):
+        return [u''.join(rng.choice(pieces) for _ in range(rng.randint(0, length))) for _ in range(count)]
+
+    delimiters = draw(_DELIMITERS, 30)
+    return {
+        'templates': FIXED_CASES['templates'] + delimiters,
+        'nested': FIXED_CASES['templates'] + delimiters,
+        'unescape': FIXED_CASES['unescape'] + draw(_ENTITIES, 12),
+        'parse': FIXED_CASES['parse'] + draw(_MARKUP, 30),
+    }
+
+
+def current(check):
+    """The function of this tree for a check"""
+    return {
+        'templates': dropTemplatesAndTables,
+        'nested': lambda text: dropNested(text, r'{{', r'}}'),
+        'unescape': unescapeNested,
+        'parse': parse,
+    }[check]
+
+
+def reference(module, check):
+    """The function of a reference parser module for a check"""
+    return {
+        'templates': lambda text: module.dropNested(module.dropNested(text, r'{{', r'}}'), r'{\|', r'\|}'),
+        'nested': lambda text: module.dropNested(text, r'{{', r'}}'),
+        'unescape': lambda text: module.unescape(module.unescape(text)),
+        'parse': lambda text: module.parse(text.encode('utf-8')),
+    }[check]
+
+
+def load_module(path):
+    try:
+        import importlib.util
+    except ImportError:  # Python 2
+        import imp
+        return imp.load_source('reference_parser', path)
+    spec = importlib.util.spec_from_file_location('reference_parser', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate(path):
+    module = load_module(path)
+    cases = make_cases()
+    with io.open(EXPECTED, 'w', encoding='ascii', newline='\n') as out:
+        out.write(u'{\n')
+        for n, check in enumerate(CHECKS):
+            func = reference(module, check)
+            out.write(u'"%s": [\n' % check)
+            lines = [json.dumps([text, func(text)]) for text in cases[check]]
+            out.write(u'%s\n]%s\n' % (u',\n'.join(lines), u',' if n < len(CHECKS) - 1 else u''))
+        out.write(u'}\n')
+    print('wrote %s' % EXPECTED)
+
+
+def check_all(show):
+    with io.open(EXPECTED, encoding='ascii') as f:
+        expected = json.load(f)
+    failed = 0
+    for check in CHECKS:
+        func = current(check)
+        changed = [(text, output, func(text)) for text, output in expected[check]]
+        changed = [case for case in changed if case[1] != case[2]]
+        print('%-10s %5d cases, %d changed' % (check, len(expected[check]), len(changed)))
+        for text, output, got in changed[:show]:
+            print('    input    %r\n    expected %r\n    got      %r' % (text, output, got))
+        failed += len(changed)
+    failed += check_timed()
+    failed += check_surrogates()
+    failed += check_pipeline()
+    failed += check_async()
+    return 1 if failed else 0
+
+
+def check_timed():
+    """Time clean_linear() on TIMED_CASES, the number of cases over TIME_LIMIT"""
+    slow = 0
+    for name, text in TIMED_CASES:
+        start = time.time()
+        clean_linear(text)
+        elapsed = time.time() - start
+        print('%-10s %-20s %.3fs%s' % ('linear', name, elapsed, '' if elapsed < TIME_LIMIT else ', too slow'))
+        slow += elapsed >= TIME_LIMIT
+    return slow
+
+
+def check_surrogates():
+    """Write the text of SURROGATE_CASES in every output, the number of cases written wrong"""
+    failed = 0
+    directory = tempfile.mkdtemp()
+    try:
+        for n, (text, expected) in enumerate(SURROGATE_CASES):
+            page = Page(n, u'Page %d' % n, 0, parse(text))
+            problems = []
+            if encode_record(page, 'text') != expected + b'\n\n':
+                problems.append('text')
+            store = os.path.join(directory, 'store%d' % n)
+            writer = StoreWriter(store)
+            writer.add(page)
+            writer.close()
+            reader = StoreReader(store)
+            if encode_utf8(reader.get(page.title)) != expected:
+                problems.append('store')
+            reader.close()
+            cache = ParseCache(path=os.path.join(directory, 'cache%d' % n))
+            cache.put('key', page.text)
+            cache.close()
+            cache = ParseCache(path=os.path.join(directory, 'cache%d' % n))
+            if encode_utf8(cache.get('key')) != expected:
+                problems.append('cache')
+            cache.close()
+            print('%-10s %-20r %s' % ('surrogate', text[:20], 'failed %s' % ', '.join(problems) if problems else 'ok'))
+            failed += bool(problems)
+    finally:
+        shutil.rmtree(directory)
+    return failed
+
+
+def check_pipeline():
+    """Check that imap_batches() raises on items its pool cannot pickle instead of waiting forever"""
+    outcome = []
+
+    def run():
+        try:
+            list(imap_batches(repr, [1, threading.Lock(), 3], workers=2, batch_size=1))
+            outcome.append('no error')
+        except RuntimeError:
+            outcome.append(None)
+        except Exception as e:
+            outcome.append('%s: %s' % (type(e).__name__, e))
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    problem = outcome[0] if outcome else 'still waiting after 10s'
+    print('%-10s %-20s %s' % ('pipeline', 'unpicklable item', 'failed %r' % problem if problem else 'ok'))
+    return 1 if problem else 0
+
+
+def check_async():
+    """Check how wikimedia2text.aio copes with failing executors and cancellations, the number of failures"""
+    try:
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from wikimedia2text.aio import AsyncParser
+    except ImportError:  # Python 2
+        return 0
+
+    class BreakingExecutor(ThreadPoolExecutor):
+        """A ThreadPoolExecutor that breaks after running a number of tasks"""
+
+        def __init__(self, tasks):
+            super(BreakingExecutor, self).__init__(1)
+            self.tasks = tasks
+
+        def submit(self, *args, **kwargs):
+            if not self.tasks:
+                raise RuntimeError('broken executor')
+            self.tasks -= 1
+            return super(BreakingExecutor, self).submit(*args, **kwargs)
+
+    def shut_down():
+        executor = ThreadPoolExecutor(1)
+        executor.shutdown()
+        parser = AsyncParser(executor=executor, max_concurrency=1)
+        return parser, [parser.parse(u'a'), parser.parse(u'b')]
+
+    def broken():
+        # the second parse is submitted from the callback of the first one
+        parser = AsyncParser(executor=BreakingExecutor(1), max_concurrency=1)
+        return parser, [parser.parse(u'a'), parser.parse(u'b'), parser.parse(u'b')]
+
+    def cancelled():
+        parser = AsyncParser(executor=ThreadPoolExecutor(1), max_concurrency=1)
+        requests = [parser.parse(u'[[a' * 2000), parser.parse(u'b'), parser.parse(u'c'), parser.parse(u'c')]
+        requests[1].cancel()
+        requests[2].cancel()
+        return parser, requests
+
+    # each check: the requests it issues, and the outcome expected for each of them
+    checks = [
+        ('shut-down executor', shut_down, [RuntimeError, RuntimeError]),
+        ('broken executor', broken, [parse(u'a'), RuntimeError, RuntimeError]),
+        ('cancelled requests', cancelled, [parse(u'[[a' * 2000), None, None, parse(u'c')]),
+    ]
+    loop = asyncio.new_event_loop()
+    errors = []
+    loop.set_exception_handler(lambda loop, context: errors.append(context['message']))
+    failed = 0
+    try:
+        for name, issue, expected in checks:
+            del errors[:]
+            try:
+                parser, requests = _in_loop(loop, issue)
+                loop.run_until_complete(asyncio.wait(requests, timeout=10))
+                outcomes = [None if r.cancelled() else r.exception() or r.result() if r.done() else 'pending'
+                            for r in requests]
+                problem = [(o, e) for o, e in zip(outcomes, expected)
+                           if not (isinstance(o, e) if isinstance(e, type) else o == e)]
+                if parser._jobs or parser._queue:
+                    problem.append('jobs left behind')
+                problem.extend(errors)
+            except Exception as e:
+                problem = ['%s: %s' % (type(e).__name__, e)]
+            print('%-10s %-20s %s' % ('async', name, 'failed %r' % problem if problem else 'ok'))
+            failed += bool(problem)
+    finally:
+        loop.close()
+    return failed
+
+
+def _in_loop(loop, func):
+    """Call func() from a callback of loop, as asyncio front ends expect, and return its result"""
+    called = loop.create_future()
+
+    def call():
+        try:
+            called.set_result(func())
+        except Exception as e:
+            called.set_exception(e)
+    loop.call_soon(call)
+    return loop.run_until_complete(called)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the cleaning with the outputs of a reference parser.')
+    parser.add_argument('--expected-from', metavar='PARSER',
+                        help='regenerate %s from this reference parser.py' % os.path.basename(EXPECTED))
+    parser.add_argument('--show', type=int, default=3, help='changed cases shown per check (default: 3)')
+    args = parser.parse_args()
+    if args.expected_from:
+        generate(args.expected_from)
+        return 0
+    return check_all(args.show)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
-from setuptools import find_packages
+from setuptools import find_packages, setup
 
 
 requirements = [
@@ -20,11 +19,17 @@ setup(
     url='http://www.github.com/brentpayne/wikimedia2text-py',
     packages=find_packages(exclude=('test*',)),
     install_requires=requirements,
+    entry_points={
+        'console_scripts': ['wikimedia2text = wikimedia2text.cli:main'],
+    },
     keywords=['wikipedia', 'wikimedia', 'parse', 'parsing', '2text'],
     classifiers=[
         "Topic :: Text Processing :: General",
         "Topic :: Text Processing",
         "Programming Language :: Python",
+        "Programming Language :: Python :: 2",
+        "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
         "Intended Audience :: Developers",
         ("License :: OSI Approved :: GNU Lesser General Public License v3" +
@@ -9,8 +9,11 @@ TODO: document frame's intent. The framer is brentpayne
 '''
 
 
-def main():
-    pass
+
+def main(argv=None):
+    """The command line, see wikimedia2text.cli; the parser alone does not load it"""
+    from wikimedia2text.cli import main
+    return main(argv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,3 @@
+from wikimedia2text.cli import main
+
+main()
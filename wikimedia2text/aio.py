@@ -0,0 +1,164 @@
+"""
+asyncio front end, for services parsing pages on demand (Python 3 only).
+
+parse() is CPU bound and would block the event loop, an AsyncParser runs it in
+ an executor instead, a pool of processes by default:
+
+    parser = AsyncParser(workers=4)
+
+    async def preview(request):
+        text = await parser.parse(wikitext)
+        ...
+
+At most max_concurrency parses are handed to the executor at once, the others
+ wait in a queue.  Concurrent requests for the same text and options share a
+ single parse.  A request can be cancelled (e.g. with asyncio.wait_for): a
+ parse nobody waits for any more is dropped if it has not started yet, and its
+ result discarded otherwise.
+
+The methods return asyncio futures, to be awaited from a coroutine running in
+ the loop.
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from wikimedia2text.parser import parse
+
+
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class _Job(object):
+    """A parse shared by the requests for the same text and options"""
+
+    def __init__(self, key, future):
+        self.key = key
+        self.future = future    # result for the requests
+        self.waiters = 0        # requests still waiting for it
+        self.started = None     # concurrent.futures future once submitted
+
+
+class AsyncParser(object):
+    """
+    parse() for asyncio applications.
+    :param workers: processes of the default executor, defaults to the number of cores
+    :param executor: a concurrent.futures executor to use instead of the default
+        one, e.g. a ThreadPoolExecutor; it is not shut down by close()
+    :param max_concurrency: parses handed to the executor at once, defaults
+        to the number of workers (or 4 with a given executor)
+    :param cleaner: the wikimedia2text.parser.Cleaner profile to clean with
+    """
+
+    def __init__(self, workers=None, executor=None, max_concurrency=None, cleaner=None):
+        self._owned = executor is None
+        self._executor = executor if executor is not None else ProcessPoolExecutor(workers)
+        self.max_concurrency = max_concurrency or workers or getattr(self._executor, '_max_workers', 4)
+        self.cleaner = cleaner
+        self._jobs = {}         # key -> _Job queued or running
+        self._queue = deque()   # _Jobs waiting for the executor
+        self._running = 0
+        self.parsed = 0         # parses run
+        self.coalesced = 0      # requests served by the parse of another one
+
+    def parse(self, text, keep_sections=False, keep_links=False):
+        """
+        parse() in the executor.
+        :return: an asyncio future of the unicode text, cancelling it cancels this request only
+        """
+        loop = _running_loop()
+        key = (text, keep_sections, keep_links)
+        job = self._jobs.get(key)
+        if job is None:
+            job = self._jobs[key] = _Job(key, loop.create_future())
+            self._queue.append(job)
+        else:
+            self.coalesced += 1
+        job.waiters += 1
+        request = loop.create_future()
+        job.future.add_done_callback(partial(_forward, request))
+        request.add_done_callback(partial(self._request_done, job))
+        self._pump(loop)
+        return request
+
+    def parse_many(self, texts, keep_sections=False, keep_links=False):
+        """parse() every text, as a future of the list of results, in order"""
+        return asyncio.gather(*[self.parse(text, keep_sections, keep_links) for text in texts])
+
+    def close(self):
+        """Cancel the queued parses and shut the default executor down"""
+        while self._queue:
+            job = self._queue.popleft()
+            self._jobs.pop(job.key, None)
+            job.future.cancel()
+        if self._owned:
+            self._executor.shutdown(wait=False)
+
+    def _pump(self, loop):
+        """Hand queued jobs to the executor while below max_concurrency"""
+        while self._queue and self._running < self.max_concurrency:
+            job = self._queue.popleft()
+            text, keep_sections, keep_links = job.key
+            try:
+                job.started = self._executor.submit(parse, text, keep_sections, keep_links, cleaner=self.cleaner)
+            except Exception as e:
+                # e.g. the executor is shut down or broken: fail the requests instead of leaving them pending
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+                if not job.future.done():
+                    job.future.set_exception(e)
+                continue
+            job.started.add_done_callback(partial(_call_soon, loop, partial(self._job_done, loop, job)))
+            self._running += 1
+            self.parsed += 1
+
+    def _job_done(self, loop, job, started):
+        # the job stays running until the executor is done with it, even once cancelled
+        self._running -= 1
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+        if not job.future.done():
+            if started.cancelled():
+                job.future.cancel()
+            elif started.exception() is not None:
+                job.future.set_exception(started.exception())
+            else:
+                job.future.set_result(started.result())
+        self._pump(loop)
+
+    def _request_done(self, job, request):
+        job.waiters -= 1
+        if job.waiters or not request.cancelled() or job.future.done():
+            return
+        # nobody waits for the job any more
+        if self._jobs.get(job.key) is job:
+            del self._jobs[job.key]
+        if job.started is None:
+            if job in self._queue:
+                self._queue.remove(job)
+        else:
+            # only possible until a worker picks the parse up
+            job.started.cancel()
+        job.future.cancel()
+
+
+def _call_soon(loop, callback, result):
+    """Run callback(result) in the loop, from the thread completing an executor future"""
+    try:
+        loop.call_soon_threadsafe(callback, result)
+    except RuntimeError:
+        # the loop is closed
+        pass
+
+
+def _forward(request, result):
+    """Pass the outcome of a shared parse on to a request"""
+    if request.done():
+        return
+    if result.cancelled():
+        request.cancel()
+    elif result.exception() is not None:
+        request.set_exception(result.exception())
+    else:
+        request.set_result(result.result())
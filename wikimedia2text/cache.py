@@ -0,0 +1,145 @@
+"""
+Cache of parse results keyed by the content of the wikimedia text.
+
+Most articles do not change from one dump to the next.  A ParseCache keeps
+ the plain text of the pages it has seen, keyed by a hash of their raw text
+ and of the options they were converted with, in an in-process LRU bounded
+ by size and, optionally, in a sqlite file that survives between runs:
+
+    cache = ParseCache(path='enwiki.cache')
+    text = cache.parse(wikitext)
+    ...
+    cache.close()
+    print(cache.report())
+
+convert_pages() and the command line (--cache) use it to send only the
+ pages missing from the cache to the workers.
+"""
+import hashlib
+import sqlite3
+import sys
+from collections import OrderedDict
+
+from wikimedia2text.parser import _convert, decode_utf8, defaultCleaner, encode_utf8
+
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
+
+# Memory budget of the LRU
+DEFAULT_MAX_BYTES = 256 << 20
+
+# Writes to the sqlite store between two commits
+COMMIT_EVERY = 1000
+
+
+class ParseCache(object):
+    """
+    Content-hash cache of converted texts.
+    :param max_bytes: size above which the least recently used texts are
+        evicted from memory (they stay in the sqlite store)
+    :param path: optional sqlite file keeping the texts between runs
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, path=None):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0           # found in memory or on disk
+        self.disk_hits = 0      # found on disk only
+        self.misses = 0
+        self.evictions = 0
+        self._lru = OrderedDict()   # key -> text, least recently used first
+        self._db = None
+        self._writes = 0
+        if path is not None:
+            self._db = sqlite3.connect(path)
+            # texts written by Python 2 may hold encoded surrogates
+            self._db.text_factory = decode_utf8
+            self._db.execute('CREATE TABLE IF NOT EXISTS parsed (key TEXT PRIMARY KEY, text TEXT NOT NULL)')
+
+    @staticmethod
+    def key(text, keep_sections=False, keep_links=False, cleaner=None):
+        """Hash of a raw (utf-8 or unicode) wikimedia text and of the conversion options"""
+        if not isinstance(text, bytes):
+            text = encode_utf8(text)
+        signature = (cleaner if cleaner is not None else defaultCleaner).signature
+        if signature:
+            # profiles other than the default one get keys of their own
+            digest = hashlib.sha1((u'%d%d/%s:' % (keep_sections, keep_links, signature)).encode('utf-8'))
+        else:
+            digest = hashlib.sha1(('%d%d:' % (keep_sections, keep_links)).encode('ascii'))
+        digest.update(text)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """The text cached under key, or None"""
+        text = self._lru.pop(key, None)
+        if text is not None:
+            self._lru[key] = text
+            self.hits += 1
+            return text
+        if self._db is not None:
+            row = self._db.execute('SELECT text FROM parsed WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                text = row[0]
+                if not isinstance(text, text_type):
+                    # stored as utf-8 by put()
+                    text = decode_utf8(bytes(text))
+                self._remember(key, text)
+                self.hits += 1
+                self.disk_hits += 1
+                return text
+        self.misses += 1
+        return None
+
+    def put(self, key, text):
+        """Cache a converted unicode text"""
+        self._remember(key, text)
+        if self._db is not None:
+            try:
+                self._db.execute('INSERT OR REPLACE INTO parsed (key, text) VALUES (?, ?)', (key, text))
+            except UnicodeEncodeError:
+                # sqlite cannot take the surrogates character references may leave on Python 3
+                self._db.execute('INSERT OR REPLACE INTO parsed (key, text) VALUES (?, ?)',
+                                 (key, sqlite3.Binary(encode_utf8(text))))
+            self._writes += 1
+            if self._writes % COMMIT_EVERY == 0:
+                self._db.commit()
+
+    def _remember(self, key, text):
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self.size -= sys.getsizeof(old)
+        self._lru[key] = text
+        self.size += sys.getsizeof(text)
+        while self.size > self.max_bytes and self._lru:
+            evicted_key, evicted = self._lru.popitem(last=False)
+            self.size -= sys.getsizeof(evicted)
+            self.evictions += 1
+
+    def parse(self, text, keep_sections=False, keep_links=False, cleaner=None):
+        """parse() going through the cache, text may be utf-8 or unicode"""
+        key = self.key(text, keep_sections, keep_links, cleaner)
+        result = self.get(key)
+        if result is None:
+            if isinstance(text, bytes):
+                text = text.decode('utf-8')
+            result = _convert(text, keep_sections, keep_links, cleaner=cleaner)
+            self.put(key, result)
+        return result
+
+    def close(self):
+        """Commit and close the sqlite store"""
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return '%d hits (%d from disk), %d misses, %.1f%% hit rate, %d evictions, %.1f MB in memory' % (
+            self.hits, self.disk_hits, self.misses, 100.0 * self.hits / lookups if lookups else 0.0,
+            self.evictions, self.size / 1e6)
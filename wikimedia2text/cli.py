@@ -0,0 +1,405 @@
+"""
+Command line front end: convert dumps, or directories of wikimedia text
+ files, into plain text, JSON lines or one file per article.
+"""
+import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+
+try:
+    from urllib import quote
+except ImportError:  # Python 3
+    from urllib.parse import quote
+
+from wikimedia2text.cache import DEFAULT_MAX_BYTES, ParseCache
+from wikimedia2text.dump import Page, Revision, iter_raw_pages, iter_revisions
+from wikimedia2text.guard import Budget
+from wikimedia2text.incremental import INDEX_SUFFIX, PageIndex, PreviousOutput, convert_revisions, index_settings
+from wikimedia2text.mapped import convert_mapped, is_compressed, iter_mapped_pages
+from wikimedia2text.parser import encode_utf8
+from wikimedia2text.pipeline import DEFAULT_BATCH_SIZE, convert_pages
+from wikimedia2text.stats import StatsCollector
+from wikimedia2text.store import StoreWriter
+
+
+FORMATS = ('text', 'jsonl', 'files', 'store')
+COMPRESSIONS = {'none': '', 'gzip': '.gz', 'bz2': '.bz2'}
+
+
+def iter_wiki_files(directory, suffix):
+    """Read every file ending in suffix below directory as one article named after the file"""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(suffix):
+                continue
+            with open(os.path.join(dirpath, filename), 'rb') as f:
+                text = f.read().decode('utf-8')
+            name = filename[:-len(suffix)]
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            yield Page(None, name, 0, text)
+
+
+def iter_inputs(paths, suffix, namespaces):
+    for path in paths:
+        if os.path.isdir(path):
+            for page in iter_wiki_files(path, suffix):
+                yield page
+        else:
+            for page in iter_raw_pages(path, namespaces):
+                yield page
+
+
+def iter_input_revisions(paths, suffix, namespaces):
+    """iter_inputs() as (Page, Revision) pairs, files having no revision"""
+    for path in paths:
+        if os.path.isdir(path):
+            for page in iter_wiki_files(path, suffix):
+                yield page, Revision(None, None)
+        else:
+            for pair in iter_revisions(path, namespaces):
+                yield pair
+
+
+def _binary(stream):
+    """The binary buffer under a Python 3 text stream, or the stream itself"""
+    return getattr(stream, 'buffer', stream)
+
+
+def _write_text(stream, text):
+    """Write unicode text to a standard stream on Python 2 and 3"""
+    if not isinstance(text, str):
+        text = text.encode('utf-8')
+    stream.write(text)
+
+
+def open_output(path, compression):
+    """Open path (or stdout for '-') for binary writing with the requested compression"""
+    if path == '-':
+        stdout = _binary(sys.stdout)
+        if compression == 'gzip':
+            return gzip.GzipFile(fileobj=stdout, mode='wb')
+        if compression == 'bz2':
+            return _BZ2Writer(stdout)
+        return stdout
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    if compression == 'bz2':
+        return bz2.BZ2File(path, 'wb')
+    return open(path, 'wb')
+
+
+class _BZ2Writer(object):
+    """bz2 compression on top of an already open stream"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._compressor = bz2.BZ2Compressor()
+
+    def write(self, data):
+        self._fileobj.write(self._compressor.compress(data))
+
+    def close(self):
+        self._fileobj.write(self._compressor.flush())
+        self._fileobj.flush()
+
+
+class Progress(object):
+    """Periodic pages/s and MB/s report on stderr"""
+
+    def __init__(self, interval, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.pages = 0
+        self.bytes = 0
+        self.started = self.reported = time.time()
+
+    def count_input(self, pages):
+        """Wrap the raw pages to measure the volume of wikimedia text read"""
+        for page in pages:
+            self.bytes += len(encode_utf8(page.text))
+            yield page
+
+    def count_mapped(self, pages):
+        """count_input() for MappedPages, whose text stays in the files"""
+        for page in pages:
+            self.bytes += page.length
+            yield page
+
+    def count_revisions(self, revisions):
+        """count_input() for (Page, Revision) pairs"""
+        for page, revision in revisions:
+            self.bytes += len(encode_utf8(page.text))
+            yield page, revision
+
+    def page_done(self):
+        self.pages += 1
+        if self.interval and time.time() - self.reported >= self.interval:
+            self.report()
+
+    def report(self):
+        self.reported = time.time()
+        elapsed = max(self.reported - self.started, 1e-9)
+        self.stream.write('%d pages, %.1f pages/s, %.2f MB/s\n' % (
+            self.pages, self.pages / elapsed, self.bytes / elapsed / 1e6))
+        self.stream.flush()
+
+
+# Longest quoted title kept in a file name, most file systems allow 255 bytes
+MAX_FILENAME_TITLE = 200
+
+
+def article_filename(page):
+    """A file name for a page, safe on any file system"""
+    name = quote(encode_utf8(page.title), safe=" ,()'-_")
+    if len(name) > MAX_FILENAME_TITLE:
+        # cut outside of a %XX escape, and tell apart the titles cut the same way
+        name = name[:MAX_FILENAME_TITLE]
+        escape = name.rfind('%', -2)
+        if escape >= 0:
+            name = name[:escape]
+        if page.id is not None:
+            name += '~%d' % page.id
+        else:
+            name += '~' + hashlib.sha1(encode_utf8(page.title)).hexdigest()[:12]
+    return name + '.txt'
+
+
+def encode_record(page, format):
+    """The bytes written for a page in the text or jsonl format"""
+    if format == 'jsonl':
+        # _asdict() keeps the fields in order on Python 2 and 3
+        return encode_utf8(json.dumps(page._asdict(), ensure_ascii=False)) + b'\n'
+    return encode_utf8(page.text) + b'\n\n'
+
+
+def write_pages(pages, args, progress):
+    if args.format == 'store':
+        writer = StoreWriter(args.output)
+        try:
+            for page in pages:
+                writer.add(page)
+                progress.page_done()
+        finally:
+            writer.close()
+        return
+    if args.format == 'files':
+        suffix = COMPRESSIONS[args.compress]
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        for page in pages:
+            out = open_output(os.path.join(args.output, article_filename(page) + suffix), args.compress)
+            try:
+                out.write(encode_utf8(page.text))
+            finally:
+                out.close()
+            progress.page_done()
+        return
+
+    out = open_output(args.output, args.compress)
+    try:
+        for page in pages:
+            out.write(encode_record(page, args.format))
+            progress.page_done()
+    finally:
+        if out is not _binary(sys.stdout):
+            out.close()
+
+
+def write_indexed(results, args, index, progress):
+    """
+    Write the (Page, Revision, record, reason) of convert_revisions() to the
+    output, reusing the previous records, and index them but for the pages
+    converted by the fallback of the budget
+    """
+    out = open_output(args.output, 'none')
+    offset = 0
+    try:
+        for page, revision, record, reason in results:
+            if record is None:
+                record = encode_record(page, args.format)
+            out.write(record)
+            if page.id is not None and reason is None:
+                index.add(page.id, revision, page.title, offset, len(record))
+            offset += len(record)
+            progress.page_done()
+    finally:
+        out.close()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='wikimedia2text',
+        description='Convert wikimedia dumps or wikimedia text files into plain text.')
+    parser.add_argument('inputs', nargs='+', metavar='INPUT',
+                        help='XML dump (plain, bz2 or gzip) or directory of wikimedia text files')
+    parser.add_argument('-o', '--output', default='-',
+                        help="output file, or directory with --format files or store (default: stdout)")
+    parser.add_argument('-f', '--format', choices=FORMATS, default='text',
+                        help='plain text, one JSON object per line, one file per article, or a store '
+                             'of compressed shards indexed by title and id (default: text)')
+    parser.add_argument('-c', '--compress', choices=sorted(COMPRESSIONS), default='none',
+                        help='compress the output (default: none)')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='worker processes (default: number of cores)')
+    parser.add_argument('-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='pages sent to a worker at once (default: %d)' % DEFAULT_BATCH_SIZE)
+    parser.add_argument('--unordered', action='store_true',
+                        help='write pages as soon as they are converted instead of in input order')
+    parser.add_argument('-n', '--namespace', type=int, action='append', dest='namespaces',
+                        help='only convert pages of this namespace number, may be repeated')
+    parser.add_argument('--suffix', default='.wiki',
+                        help='suffix of the wikimedia text files read from directories (default: .wiki)')
+    parser.add_argument('--keep-sections', action='store_true',
+                        help='keep section titles and list items as html tags')
+    parser.add_argument('--keep-links', action='store_true',
+                        help='keep internal links as html anchors')
+    parser.add_argument('--progress', type=float, default=10, metavar='SECONDS',
+                        help='report throughput on stderr every SECONDS, 0 disables (default: 10)')
+    parser.add_argument('--stats', type=int, default=0, metavar='N',
+                        help='profile every stage and report percentiles and the N slowest pages on stderr')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='sqlite file caching the converted text of every page, '
+                             'so unchanged pages are not converted again on the next run')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_BYTES >> 20, metavar='MB',
+                        help='memory used by the cache (default: %d)' % (DEFAULT_MAX_BYTES >> 20))
+    parser.add_argument('--max-seconds', type=float, default=0, metavar='SECONDS',
+                        help='convert pages taking longer than SECONDS with a cruder linear time cleaner')
+    parser.add_argument('--max-size', type=int, default=0, metavar='CHARS',
+                        help='convert pages longer than CHARS with a cruder linear time cleaner')
+    parser.add_argument('--index', action='store_true',
+                        help='index the records of the output by page id and revision in OUTPUT%s, '
+                             'for a later --previous' % INDEX_SUFFIX)
+    parser.add_argument('--previous', metavar='FILE',
+                        help='output of a previous dump, converted with --index: the pages whose revision '
+                             'did not change are copied from it instead of being converted again')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map uncompressed dumps and wikimedia text files, the workers read '
+                             'the pages from the mapping instead of receiving them')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    if args.format in ('files', 'store') and args.output == '-':
+        make_parser().error('--format %s needs an output directory' % args.format)
+    if args.format == 'store' and args.compress != 'none':
+        make_parser().error('--format store is compressed already')
+    if args.cache and args.stats:
+        make_parser().error('--stats cannot be combined with --cache')
+    if args.stats and (args.max_seconds or args.max_size):
+        make_parser().error('--stats cannot be combined with --max-seconds or --max-size')
+    if args.previous and not args.index:
+        make_parser().error('--previous needs --index')
+    if args.index:
+        if args.format in ('files', 'store') or args.compress != 'none' or args.output == '-':
+            make_parser().error('--index needs a text or jsonl output file without compression')
+        if args.cache or args.stats:
+            make_parser().error('--index cannot be combined with --cache or --stats')
+        if args.previous and os.path.abspath(args.previous) == os.path.abspath(args.output):
+            make_parser().error('--previous must not be the output')
+    if args.mmap and (args.cache or args.index):
+        make_parser().error('--mmap cannot be combined with --cache or --index')
+    if args.mmap:
+        for path in args.inputs:
+            if not os.path.isdir(path) and is_compressed(path):
+                make_parser().error('--mmap needs uncompressed inputs, %s is compressed' % path)
+
+    cache = None
+    if args.cache:
+        cache = ParseCache(max_bytes=args.cache_size << 20, path=args.cache)
+    budget = None
+    if args.max_seconds or args.max_size:
+        budget = Budget(max_seconds=args.max_seconds or None, max_size=args.max_size or None,
+                        on_exceeded=report_exceeded)
+    progress = Progress(args.progress)
+    if args.index:
+        convert_indexed(args, budget, progress)
+        return
+    if args.mmap:
+        pages = convert_mapped_inputs(args, budget, progress)
+    else:
+        pages = progress.count_input(iter_inputs(args.inputs, args.suffix, args.namespaces))
+        pages = convert_pages(pages, workers=args.workers, batch_size=args.batch_size,
+                              ordered=not args.unordered,
+                              keep_sections=args.keep_sections, keep_links=args.keep_links,
+                              stats=bool(args.stats), cache=cache, budget=budget)
+    collector = None
+    if args.stats:
+        collector = StatsCollector(slowest=args.stats)
+        pages = collect_stats(pages, collector)
+    try:
+        write_pages(pages, args, progress)
+    finally:
+        if cache is not None:
+            cache.close()
+    if args.progress:
+        progress.report()
+    if cache is not None:
+        sys.stderr.write('cache: %s\n' % cache.report())
+    if collector:
+        _write_text(sys.stderr, collector.report() + u'\n')
+
+
+def convert_mapped_inputs(args, budget, progress):
+    def pages():
+        for path in args.inputs:
+            for page in iter_mapped_pages(path, args.namespaces, args.suffix):
+                yield page
+
+    return convert_mapped(progress.count_mapped(pages()), workers=args.workers, batch_size=args.batch_size,
+                          ordered=not args.unordered,
+                          keep_sections=args.keep_sections, keep_links=args.keep_links,
+                          stats=bool(args.stats), budget=budget)
+
+
+def convert_indexed(args, budget, progress):
+    """main() for --index, converting only what --previous lacks"""
+    settings = index_settings(args.format, args.keep_sections, args.keep_links)
+    previous = None
+    if args.previous:
+        try:
+            previous = PreviousOutput(args.previous, settings)
+        except ValueError as e:
+            make_parser().error(str(e))
+    index = PageIndex(args.output + INDEX_SUFFIX, settings, create=True)
+    try:
+        revisions = progress.count_revisions(iter_input_revisions(args.inputs, args.suffix, args.namespaces))
+        results = convert_revisions(revisions, previous, workers=args.workers, batch_size=args.batch_size,
+                                    ordered=not args.unordered, keep_sections=args.keep_sections,
+                                    keep_links=args.keep_links, budget=budget)
+        write_indexed(results, args, index, progress)
+    finally:
+        index.close()
+        if previous is not None:
+            previous.close()
+    if args.progress:
+        progress.report()
+    if previous is not None:
+        sys.stderr.write('%d of %d pages copied from %s\n' % (previous.reused, progress.pages, args.previous))
+
+
+def page_label(page):
+    return page.title if page.id is None else u'%s (%d)' % (page.title, page.id)
+
+
+def collect_stats(pages, collector):
+    """Feed the PageStats to the collector, passing the pages on"""
+    for page, stats in pages:
+        collector.add(page_label(page), stats)
+        yield page
+
+
+def report_exceeded(page, reason):
+    """Log on stderr a page converted by the fallback of the budget"""
+    _write_text(sys.stderr, u'%s over budget (%s), converted by the linear cleaner\n' % (page_label(page), reason))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Streaming access to MediaWiki XML dumps (pages-articles.xml and friends).
+
+The dump is read incrementally with ElementTree's iterparse, and every page
+ element is released as soon as it has been handed out, so memory stays flat
+ no matter how large the dump is.  Plain, bz2 (including multistream) and
+ gzip compressed dumps are detected from their magic bytes.
+"""
+import bz2
+import zlib
+from collections import namedtuple
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:  # Python 3.9+
+    from xml.etree import ElementTree
+
+from wikimedia2text.parser import _convert
+from wikimedia2text.stats import PageStats
+
+
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
+
+
+Page = namedtuple('Page', ['id', 'title', 'namespace', 'text'])
+
+# Id and sha1 (base 36, as in the dump) of the revision of a page, None when missing
+Revision = namedtuple('Revision', ['id', 'sha1'])
+
+# Size of the compressed blocks pulled from the underlying file
+_CHUNK_SIZE = 1 << 16
+
+_BZ2_MAGIC = b'BZh'
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+class _DecompressingReader(object):
+    """
+    File-like wrapper decompressing a stream on the fly.
+    Concatenated streams (bz2 multistream, multi-member gzip) are decoded
+    back to back by starting a fresh decompressor whenever one finishes.
+    """
+
+    def __init__(self, fileobj, factory):
+        self._fileobj = fileobj
+        self._factory = factory
+        self._decompressor = factory()
+        self._buffer = b''
+
+    def _decompress(self, data):
+        out = []
+        while data:
+            try:
+                out.append(self._decompressor.decompress(data))
+            except EOFError:
+                # the previous bz2 stream ended exactly on a chunk boundary
+                self._decompressor = self._factory()
+                continue
+            data = self._decompressor.unused_data
+            if data:
+                self._decompressor = self._factory()
+        return b''.join(out)
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = self._fileobj.read(_CHUNK_SIZE)
+            if not chunk:
+                break
+            self._buffer += self._decompress(chunk)
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+class _PrefixedReader(object):
+    """Give back the bytes consumed while sniffing a non seekable stream."""
+
+    def __init__(self, prefix, fileobj):
+        self._prefix = prefix
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self._prefix:
+            return self._fileobj.read(size)
+        if size < 0:
+            data, self._prefix = self._prefix + self._fileobj.read(), b''
+            return data
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        if len(data) < size:
+            data += self._fileobj.read(size - len(data))
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+
+def open_dump(source):
+    """
+    Open a dump for reading, transparently decompressing it.
+    :param source: a path or a binary file object
+    :return: a binary file-like object yielding the XML
+    """
+    if hasattr(source, 'read'):
+        fileobj = source
+    else:
+        fileobj = open(source, 'rb')
+    magic = fileobj.read(3)
+    fileobj = _PrefixedReader(magic, fileobj)
+    if magic.startswith(_BZ2_MAGIC):
+        return _DecompressingReader(fileobj, bz2.BZ2Decompressor)
+    if magic.startswith(_GZIP_MAGIC):
+        return _DecompressingReader(fileobj, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+    return fileobj
+
+
+def _local(tag):
+    """Strip the export schema namespace from a tag name"""
+    return tag.rsplit('}', 1)[-1]
+
+
+def _child(elem, name):
+    for child in elem:
+        if _local(child.tag) == name:
+            return child
+    return None
+
+
+def iter_raw_pages(source, namespaces=None):
+    """
+    Iterate over the pages of a dump without converting them.
+    Only the page currently yielded is kept in memory.
+    :param source: a path or a binary file object, optionally bz2/gzip compressed
+    :param namespaces: if given, only pages in these namespace numbers are returned
+    :return: a generator of Page tuples holding the raw wikimedia text
+    """
+    for page, revision in iter_revisions(source, namespaces):
+        yield page
+
+
+def iter_revisions(source, namespaces=None):
+    """
+    iter_raw_pages() also giving the revision of every page.
+    :return: a generator of (Page, Revision) pairs
+    """
+    stream = open_dump(source)
+    try:
+        root = None
+        for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                continue
+            if _local(elem.tag) != 'page':
+                continue
+            ns = _child(elem, 'ns')
+            namespace = int(ns.text) if ns is not None and ns.text else 0
+            if namespaces is None or namespace in namespaces:
+                page_id = _child(elem, 'id')
+                title = _child(elem, 'title')
+                text = revision_id = sha1 = None
+                revision = _child(elem, 'revision')
+                if revision is not None:
+                    text = _child(revision, 'text')
+                    revision_id = _child(revision, 'id')
+                    sha1 = _child(revision, 'sha1')
+                yield (Page(int(page_id.text) if page_id is not None else None,
+                            text_type(title.text or u'') if title is not None else u'',
+                            namespace,
+                            text_type(text.text or u'') if text is not None else u''),
+                       Revision(int(revision_id.text) if revision_id is not None and revision_id.text else None,
+                                sha1.text if sha1 is not None and sha1.text else None))
+            # drop the page and everything collected so far under the root
+            elem.clear()
+            root.clear()
+    finally:
+        if not hasattr(source, 'read'):
+            stream.close()
+
+
+def iter_pages(source, namespaces=None, keep_sections=False, keep_links=False, cleaner=None):
+    """
+    Stream a dump, converting every page into plain text.
+    :param source: a path or a binary file object, optionally bz2/gzip compressed
+    :param namespaces: if given, only pages in these namespace numbers are returned
+    :param keep_sections: passed on to compact()
+    :param keep_links: passed on to clean()
+    :param cleaner: the wikimedia2text.parser.Cleaner profile to clean with
+    :return: a generator of (page_id, title, namespace, cleaned_text) Page tuples
+    """
+    for page in iter_raw_pages(source, namespaces):
+        yield convert_page(page, keep_sections, keep_links, cleaner=cleaner)
+
+
+def convert_page(page, keep_sections=False, keep_links=False, stats=False, cleaner=None, budget=None):
+    """
+    Replace the raw wikimedia text of a Page by its plain text.
+    :param stats: if true, return a (Page, PageStats) pair instead
+    :param cleaner: the wikimedia2text.parser.Cleaner profile to clean with
+    :param budget: optional wikimedia2text.guard.Budget, a (Page, reason) pair is
+        returned instead, reason being None unless the page exceeded the budget
+    """
+    if budget is not None:
+        text, reason = budget.convert(page.text, keep_sections, keep_links, cleaner)
+        return page._replace(text=text), reason
+    if not stats:
+        return page._replace(text=_convert(page.text, keep_sections, keep_links, cleaner=cleaner))
+    page_stats = PageStats()
+    page = page._replace(text=_convert(page.text, keep_sections, keep_links, stats=page_stats, cleaner=cleaner))
+    return page, page_stats
@@ -0,0 +1,284 @@
+"""
+Bounded work on pathological pages.
+
+A few patterns of clean() backtrack heavily on malformed markup: unbalanced
+ internal links, external links without a closing bracket, unclosed
+ discarded elements.  A handful of vandalised pages can then hold a worker
+ for minutes.  A Budget caps the size of the pages cleaned normally and the
+ time spent on each of them; the pages exceeding it are converted with
+ clean_linear() instead, a cruder cleaner running in linear time, and are
+ reported to a callback:
+
+    def report(page, reason):
+        log.warning('%s: %s', page.title, reason)
+
+    budget = Budget(max_seconds=2, max_size=4 << 20, on_exceeded=report)
+    text = budget.parse(wikitext)
+
+convert_pages(), convert_dump() and the command line (--max-seconds,
+ --max-size) take a budget as well.  Where a timer signal can be used (the
+ main thread on Unix, which includes the worker processes) a stage running
+ out of time is interrupted; elsewhere the time is checked between stages.
+"""
+import re
+import signal
+from timeit import default_timer as timer
+
+from wikimedia2text.parser import (ASCII, _cleanupStage, _convert, _templatesStage, _unescapeStage,
+                                   clean_stages, compact, defaultCleaner, make_anchor_tag)
+
+
+class Budget(object):
+    """
+    Limits on the conversion of a page.
+    :param max_seconds: time allowed to clean and compact a page
+    :param max_size: length (in characters) above which a page is not cleaned normally
+    :param on_exceeded: called with the page (the text given to parse(), a
+        Page in the pipeline) and the reason, for every page exceeding the budget
+    :param interrupt: stop the cleaning as soon as the time is over, when a timer
+        signal is available, rather than at the end of the stage
+    """
+
+    def __init__(self, max_seconds=None, max_size=None, on_exceeded=None, interrupt=True):
+        self.max_seconds = max_seconds
+        self.max_size = max_size
+        self.on_exceeded = on_exceeded
+        self.interrupt = interrupt
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the pages are reported in the calling process
+        state['on_exceeded'] = None
+        return state
+
+    def convert(self, text, keep_sections=False, keep_links=False, cleaner=None):
+        """
+        parse() within the budget, for unicode text.
+        :return: the text and None, or the text from clean_linear() and the
+            reason the page exceeded the budget
+        """
+        if self.max_size is not None and len(text) > self.max_size:
+            reason = 'size %d above %d' % (len(text), self.max_size)
+            return _convertLinear(text, keep_sections, keep_links, cleaner), reason
+        if self.max_seconds is None:
+            return _convert(text, keep_sections, keep_links, cleaner=cleaner), None
+        clock = _Clock(self.max_seconds)
+        try:
+            if self.interrupt:
+                clock.arm()
+            try:
+                return _convert(text, keep_sections, keep_links, stats=clock, cleaner=cleaner), None
+            finally:
+                clock.disarm()
+        except _OutOfTime as e:
+            clock.disarm()
+            return _convertLinear(text, keep_sections, keep_links, cleaner), e.reason
+
+    def parse(self, text, keep_sections=False, keep_links=False, cleaner=None):
+        """parse() within the budget, text may be utf-8 or unicode"""
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        result, reason = self.convert(text, keep_sections, keep_links, cleaner)
+        if reason is not None and self.on_exceeded is not None:
+            self.on_exceeded(text, reason)
+        return result
+
+
+class _OutOfTime(Exception):
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+
+# Stages, as parse() records them
+_stageNames = [name for name, stage in clean_stages] + ['compact']
+
+
+class _Clock(object):
+    """
+    Stats recorder of clean() running out of time: the time is checked after
+    every stage, and while armed a timer signal interrupts the stage in progress.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started = timer()
+        self.stages = 0
+        self._previous = None   # signal handler replaced while armed
+
+    def record(self, stage, seconds, size_in, size_out, matches):
+        self.stages += 1
+        elapsed = timer() - self.started
+        if elapsed > self.seconds:
+            raise _OutOfTime('%.2f s after stage %s' % (elapsed, stage))
+
+    def arm(self):
+        if not hasattr(signal, 'setitimer'):
+            return
+        try:
+            self._previous = signal.signal(signal.SIGALRM, self._expired)
+        except ValueError:
+            # not in the main thread
+            return
+        signal.setitimer(signal.ITIMER_REAL, self.seconds)
+
+    def disarm(self):
+        if self._previous is None:
+            return
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, self._previous)
+        self._previous = None
+
+    def _expired(self, signum, frame):
+        if self._previous is None:
+            return
+        # fire once: disarm() may still be running when the exception is raised
+        signal.signal(signal.SIGALRM, self._previous)
+        self._previous = None
+        stage = _stageNames[min(self.stages, len(_stageNames) - 1)]
+        raise _OutOfTime('%.2f s in stage %s' % (timer() - self.started, stage))
+
+
+def _convertLinear(text, keep_sections, keep_links, cleaner):
+    return u"\n".join(compact(clean_linear(text, keep_links, cleaner=cleaner), keep_sections=keep_sections))
+
+
+def clean_linear(text, keep_links=False, placeholders=None, cleaner=None):
+    """
+    Approximation of clean() running in linear time whatever the markup.
+    Templates, tables, entities and the final cleanup are handled as clean()
+    does; links, emphasis and tags by patterns that cannot backtrack.
+    Elements are dropped up to their first closing tag, never nested.
+    See clean() for the parameters.
+    """
+    if cleaner is None:
+        cleaner = defaultCleaner
+    for name, stage in linear_stages:
+        text = stage(text, keep_links, placeholders, cleaner)[0]
+    return text
+
+
+# Innermost internal links, whose target and anchor hold no bracket
+innerLink = re.compile(r'\[\[([^\[\]|]*)(?:\|([^\[\]]*))?\]\](\w*)', ASCII)
+
+# Nesting of internal links expanded, [[File:...|[[link]]...]] needs two passes
+MAX_LINK_NESTING = 3
+
+# External links, with or without an anchor
+linearExternalLink = re.compile(r'\[\w[^\[\] ]* ([^\[\]]*)\]', ASCII)
+linearExternalLinkNoAnchor = re.compile(r'\[\w[^\[\] ]*\]', ASCII)
+
+# Bold, italic, and bold italic quotes
+emphasisQuotes = re.compile(r"'{2,}")
+
+# An opening, closing or self-closing tag
+anyTag = re.compile(r'<(\s*/)?\s*(\w+)\b([^<>]*)>', ASCII)
+
+
+def _linearLinksStage(text, keep_links, placeholders, cleaner):
+    namespaces = cleaner.accepted_namespaces
+    count = 0
+    for _ in range(MAX_LINK_NESTING):
+        text, n = innerLink.subn(lambda m: make_anchor_tag(m, keep_links, namespaces), text)
+        count += n
+        if not n:
+            break
+    text = text.replace('[[', '').replace(']]', '')
+    text, n = linearExternalLink.subn(r'\1', text)
+    count += n
+    text, n = linearExternalLinkNoAnchor.subn('', text)
+    return text, count + n
+
+
+def _linearEmphasisStage(text, keep_links, placeholders, cleaner):
+    return emphasisQuotes.subn(lambda m: '&quot;' if len(m.group()) == 2 else '', text)
+
+
+def _dropComments(text):
+    """Drop <!-- --> comments, an unclosed one running to the end of the text"""
+    pieces = []
+    start = 0
+    i = text.find('<!--')
+    while i >= 0:
+        pieces.append(text[start:i])
+        end = text.find('-->', i + 4)
+        if end < 0:
+            start = len(text)
+            break
+        start = end + 3
+        i = text.find('<!--', start)
+    if not pieces:
+        return text, 0
+    pieces.append(text[start:])
+    return text[:0].join(pieces), len(pieces) - 1
+
+
+def _linearTagsStage(text, keep_links, placeholders, cleaner):
+    text, count = _dropComments(text)
+    if '<' not in text:
+        return text, count
+    known = set(cleaner.ignored_tags) | set(cleaner.self_closing_tags) | set(cleaner.discard_elements)
+    placeholder_tags = cleaner.placeholder_tags
+    elements = set(cleaner.discard_elements) | set(placeholder_tags)
+
+    tags = [(m.start(), m.end(), m.group(2).lower(), bool(m.group(1)), m.group(3).endswith('/'))
+            for m in anyTag.finditer(text)]
+    # index of the next closing tag of the same name, found by a backward sweep
+    nextClosing = [None] * len(tags)
+    closing = {}
+    for i in range(len(tags) - 1, -1, -1):
+        name, isClosing = tags[i][2], tags[i][3]
+        nextClosing[i] = closing.get(name)
+        if isClosing:
+            closing[name] = i
+
+    pieces = []
+    start = 0
+    numbers = dict((name, 0) for name in placeholder_tags)
+    seen = {}
+    i = 0
+    while i < len(tags):
+        s, e, name, isClosing, selfClosing = tags[i]
+        i += 1
+        if name not in known and name not in elements:
+            continue
+        pieces.append(text[start:s])
+        start = e
+        count += 1
+        if isClosing or selfClosing or name not in elements or nextClosing[i - 1] is None:
+            continue
+        # drop the element up to its first closing tag
+        close = nextClosing[i - 1]
+        start = tags[close][1]
+        if name in placeholder_tags:
+            numbers[name] += 1
+            block = text[s:start]
+            placeholder = seen.get(block)
+            if placeholder is None:
+                placeholder = seen[block] = '%s_%d' % (placeholder_tags[name], numbers[name])
+                if placeholders is not None:
+                    placeholders.append((placeholder, text[e:tags[close][0]]))
+            pieces.append(placeholder)
+        i = close + 1
+    pieces.append(text[start:])
+    return text[:0].join(pieces), count
+
+
+def _anyProfile(stage):
+    """A stage of clean() which does not depend on the profile"""
+    return lambda text, keep_links, placeholders, cleaner: stage(text, keep_links, placeholders)
+
+
+##
+# The stages of clean_linear(), as (name, function); the functions take the
+# text, keep_links, placeholders and the Cleaner profile.
+#
+linear_stages = [
+    ('templates', _anyProfile(_templatesStage)),
+    ('links', _linearLinksStage),
+    ('emphasis', _linearEmphasisStage),
+    ('unescape', _anyProfile(_unescapeStage)),
+    ('tags', _linearTagsStage),
+    ('cleanup', _anyProfile(_cleanupStage)),
+]
@@ -0,0 +1,150 @@
+"""
+Incremental conversion of successive dumps.
+
+Monthly dumps differ by a small fraction of pages.  Next to an output file, a
+ PageIndex records for every page its revision id, the sha1 of its text and
+ where its record lies in the file.  When the next dump is converted with the
+ previous output at hand, the pages whose revision did not change are copied
+ from it as they are, and only the new or edited pages are cleaned:
+
+    wikimedia2text enwiki-20240101.xml.bz2 -f jsonl -o jan.jsonl --index
+    wikimedia2text enwiki-20240201.xml.bz2 -f jsonl -o feb.jsonl --index --previous jan.jsonl
+
+The output must be an uncompressed file for its records to be read back, and
+ both runs must use the same options, which the index records.
+"""
+import os
+import sqlite3
+from collections import namedtuple
+from functools import partial
+
+from wikimedia2text.dump import convert_page
+from wikimedia2text.parser import defaultCleaner
+from wikimedia2text.pipeline import DEFAULT_BATCH_SIZE, _convert_missing, imap_batches
+
+
+# The index of an output file is next to it, under its name with this suffix
+INDEX_SUFFIX = '.index'
+
+IndexEntry = namedtuple('IndexEntry', ['revision', 'sha1', 'title', 'offset', 'length'])
+
+
+def index_settings(format, keep_sections=False, keep_links=False, cleaner=None):
+    """What the records of an output depend on, recorded in its index"""
+    return u'%s;%d%d;%s' % (format, keep_sections, keep_links, (cleaner if cleaner is not None else defaultCleaner).signature)
+
+
+class PageIndex(object):
+    """
+    sqlite index of the records of an output file by page id.
+    :param path: the sqlite file
+    :param settings: see index_settings(); when creating the index they are
+        recorded, otherwise they are checked against the recorded ones
+    :param create: start a new index, replacing any file at path
+    """
+
+    def __init__(self, path, settings, create=False):
+        if create and os.path.exists(path):
+            os.remove(path)
+        elif not create and not os.path.exists(path):
+            raise ValueError('no index %s' % path)
+        self._db = sqlite3.connect(path)
+        if create:
+            self._db.execute('CREATE TABLE settings (value TEXT NOT NULL)')
+            self._db.execute('INSERT INTO settings (value) VALUES (?)', (settings,))
+            self._db.execute('CREATE TABLE pages (id INTEGER PRIMARY KEY, revision INTEGER, sha1 TEXT, '
+                             'title TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL)')
+            return
+        recorded = self._db.execute('SELECT value FROM settings').fetchone()[0]
+        if recorded != settings:
+            self._db.close()
+            raise ValueError('%s was made with other options (%s instead of %s)' % (path, recorded, settings))
+
+    def get(self, page_id):
+        """The IndexEntry of a page, or None"""
+        row = self._db.execute('SELECT revision, sha1, title, offset, length FROM pages WHERE id = ?',
+                               (page_id,)).fetchone()
+        return IndexEntry(*row) if row is not None else None
+
+    def add(self, page_id, revision, title, offset, length):
+        """Record where the record of page_id, in its Revision, lies in the output"""
+        self._db.execute('INSERT OR REPLACE INTO pages (id, revision, sha1, title, offset, length) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (page_id, revision.id, revision.sha1, title, offset, length))
+
+    def close(self):
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+
+class PreviousOutput(object):
+    """
+    An indexed output file the records of the unchanged pages are read from.
+    :param path: the output file, its index being path + INDEX_SUFFIX
+    :param settings: see index_settings(), they must be those of the index
+    """
+
+    def __init__(self, path, settings):
+        self.index = PageIndex(path + INDEX_SUFFIX, settings)
+        self._file = open(path, 'rb')
+        self.reused = 0
+
+    def record(self, page, revision):
+        """The previous record of page if its Revision is the same, or None"""
+        if page.id is None:
+            return None
+        entry = self.index.get(page.id)
+        if entry is None or entry.title != page.title:
+            return None
+        if not ((revision.id is not None and entry.revision == revision.id) or
+                (revision.sha1 is not None and entry.sha1 == revision.sha1)):
+            return None
+        self._file.seek(entry.offset)
+        record = self._file.read(entry.length)
+        if len(record) != entry.length:
+            return None
+        self.reused += 1
+        return record
+
+    def close(self):
+        self.index.close()
+        self._file.close()
+
+
+def convert_revisions(revisions, previous=None, workers=None, batch_size=DEFAULT_BATCH_SIZE, ordered=True,
+                      keep_sections=False, keep_links=False, cleaner=None, budget=None):
+    """
+    Convert the pages of a dump, except those whose previous record can be reused.
+    Only the pages to convert are sent to the worker processes.
+    :param revisions: (Page, Revision) pairs, see wikimedia2text.dump.iter_revisions()
+    :param previous: optional PreviousOutput of the records to reuse
+    See wikimedia2text.pipeline.convert_pages() for the other parameters.
+    :return: a generator of (Page, Revision, record, reason), record being the
+        bytes of the previous record, the Page still holding the raw text, for
+        the pages reused, and None for the pages converted; reason is why a page
+        exceeded the budget, None for the others.  The pages converted by the
+        fallback of the budget must not be indexed, or they would be reused as
+        they are by the next runs, with or without a budget.
+    """
+    pending = {}    # seq -> (raw page, revision, previous record or None)
+
+    def lookup():
+        for seq, (page, revision) in enumerate(revisions):
+            record = previous.record(page, revision) if previous is not None else None
+            pending[seq] = page, revision, record
+            yield seq, None if record is not None else page
+
+    func = partial(convert_page, keep_sections=keep_sections, keep_links=keep_links, cleaner=cleaner, budget=budget)
+    for seq, converted in imap_batches(partial(_convert_missing, func), lookup(), workers=workers,
+                                       batch_size=batch_size, ordered=ordered):
+        page, revision, record = pending.pop(seq)
+        if converted is None:
+            yield page, revision, record, None
+            continue
+        reason = None
+        if budget is not None:
+            converted, reason = converted
+            if reason is not None and budget.on_exceeded is not None:
+                budget.on_exceeded(converted, reason)
+        yield converted, revision, None, reason
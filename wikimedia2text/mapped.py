@@ -0,0 +1,239 @@
+"""
+Memory-mapped input, for local corpora: uncompressed dumps and directories of
+ wikimedia text files.
+
+Reading such inputs into Python strings copies every page into the reading
+ process, and again into the worker processes when the pages are pickled to
+ them.  Here the reading process maps the file and locates the pages with
+ find() over the mapping, without decoding them; what goes to the workers is a
+ MappedPage, the position of the text in the file.  Every worker maps the
+ file in turn (the operating system shares the pages of the mapping between
+ them) and decodes the text of a page only just before cleaning it:
+
+    pages = iter_mapped_pages('enwiki-pages-articles.xml', namespaces=[0])
+    for page in convert_mapped(pages, workers=32):
+        ...
+
+The dump is expected as MediaWiki writes it, one <page> element after the
+ other; compressed dumps cannot be mapped and are refused, read them with
+ wikimedia2text.dump instead.  The command line reads its inputs this way
+ with --mmap.
+"""
+import mmap
+import os
+import re
+from collections import OrderedDict, namedtuple
+from functools import partial
+
+from wikimedia2text.dump import _BZ2_MAGIC, _GZIP_MAGIC, Page, convert_page
+from wikimedia2text.pipeline import DEFAULT_BATCH_SIZE, _report_exceeded, imap_batches
+
+
+try:
+    text_type = unicode
+    _chr = unichr
+except NameError:  # Python 3
+    text_type = str
+    _chr = chr
+
+
+# A page whose text lies in the length bytes at offset of the file at path,
+# escaped as XML character data when xml is true
+MappedPage = namedtuple('MappedPage', ['id', 'title', 'namespace', 'path', 'offset', 'length', 'xml'])
+
+# Files kept mapped by a process
+MAX_MAPPINGS = 16
+
+
+def iter_mapped_pages(path, namespaces=None, suffix='.wiki'):
+    """
+    Locate the pages of an uncompressed dump, or of the files of a directory.
+    :param path: an uncompressed XML dump, or a directory of wikimedia text files
+    :param namespaces: if given, only the pages of a dump in these namespace numbers are returned
+    :param suffix: suffix of the files read from a directory, each one an article named after the file
+    :return: a generator of MappedPage
+    """
+    if os.path.isdir(path):
+        return iter_mapped_files(path, suffix)
+    return iter_mapped_dump(path, namespaces)
+
+
+def iter_mapped_files(directory, suffix='.wiki'):
+    """MappedPages of the files ending in suffix below directory"""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(suffix):
+                continue
+            path = os.path.join(dirpath, filename)
+            name = filename[:-len(suffix)]
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            yield MappedPage(None, name, 0, path, 0, os.path.getsize(path), False)
+
+
+def iter_mapped_dump(path, namespaces=None):
+    """
+    MappedPages of an uncompressed dump, in the order of iter_raw_pages().
+    Only the id, title and namespace of the pages are decoded.
+    """
+    if is_compressed(path):
+        raise ValueError('%s is compressed, it cannot be memory-mapped' % path)
+    if not os.path.getsize(path):
+        return
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        start = mapped.find(b'<page>')
+        while start >= 0:
+            end = mapped.find(b'</page>', start)
+            if end < 0:
+                break
+            ns = _element(mapped, b'ns', start, end)
+            namespace = int(ns) if ns else 0
+            if namespaces is None or namespace in namespaces:
+                revision = mapped.find(b'<revision>', start, end)
+                head = revision if revision >= 0 else end
+                page_id = _element(mapped, b'id', start, head)
+                title = _element(mapped, b'title', start, head)
+                offset, length = _textRegion(mapped, revision, end) if revision >= 0 else (0, 0)
+                yield MappedPage(int(page_id) if page_id else None,
+                                 unescape_xml(title.decode('utf-8')) if title else u'',
+                                 namespace, path, offset, length, True)
+            start = mapped.find(b'<page>', end)
+    finally:
+        mapped.close()
+
+
+def is_compressed(path):
+    """Whether the dump at path is bz2 or gzip compressed"""
+    with open(path, 'rb') as f:
+        magic = f.read(3)
+    return magic.startswith(_BZ2_MAGIC) or magic.startswith(_GZIP_MAGIC)
+
+
+def _element(mapped, name, start, end):
+    """The content of the first <name> element in mapped[start:end], or None"""
+    opening = b'<' + name + b'>'
+    i = mapped.find(opening, start, end)
+    if i < 0:
+        return None
+    i += len(opening)
+    j = mapped.find(b'</' + name + b'>', i, end)
+    return mapped[i:j] if j >= 0 else None
+
+
+def _textRegion(mapped, start, end):
+    """Offset and length of the content of the first <text> element in mapped[start:end]"""
+    i = mapped.find(b'<text', start, end)
+    if i < 0:
+        return 0, 0
+    i = mapped.find(b'>', i, end)
+    if i < 0 or mapped[i - 1:i] == b'/':
+        # <text ... /> of a deleted or empty revision
+        return 0, 0
+    j = mapped.find(b'</text>', i, end)
+    if j < 0:
+        return 0, 0
+    return i + 1, j - i - 1
+
+
+# Character and entity references of XML
+xmlReference = re.compile(r'&(?:(lt|gt|amp|quot|apos)|#(\d+)|#x([0-9a-fA-F]+));')
+
+xmlEntities = {'lt': u'<', 'gt': u'>', 'amp': u'&', 'quot': u'"', 'apos': u"'"}
+
+
+def _xmlCharacter(match):
+    if match.group(1):
+        return xmlEntities[match.group(1)]
+    code = int(match.group(2)) if match.group(2) else int(match.group(3), 16)
+    try:
+        return _chr(code)
+    except ValueError:  # narrow Python 2 build
+        return (b'\\U%08x' % code).decode('unicode-escape')
+
+
+def unescape_xml(text):
+    """The character data of unicode XML text, as an XML parser reports it"""
+    if u'\r' in text:
+        text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    if u'&' not in text:
+        return text
+    return xmlReference.sub(_xmlCharacter, text)
+
+
+_mappings = OrderedDict()   # path -> mmap of the files mapped by this process, least recently used first
+
+
+def _mapping(path):
+    mapped = _mappings.pop(path, None)
+    if mapped is None:
+        if len(_mappings) >= MAX_MAPPINGS:
+            _mappings.popitem(last=False)[1].close()
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _mappings[path] = mapped
+    return mapped
+
+
+def close_mappings():
+    """Unmap the files mapped by read_page() in this process"""
+    while _mappings:
+        _mappings.popitem()[1].close()
+
+
+def _decode(mapped, start, end):
+    """Decode mapped[start:end], straight from the mapping where it exposes a buffer"""
+    try:
+        view = memoryview(mapped)
+    except TypeError:  # Python 2 mmaps only have the old buffer interface
+        return mapped[start:end].decode('utf-8')
+    try:
+        region = view[start:end]
+        try:
+            return text_type(region, 'utf-8')
+        finally:
+            # the mapping cannot be closed while a view on it is alive
+            region.release()
+    finally:
+        view.release()
+
+
+def read_page(page):
+    """The Page holding the raw wikimedia text of a MappedPage, read from the mapping of its file"""
+    text = u''
+    if page.length:
+        text = _decode(_mapping(page.path), page.offset, page.offset + page.length)
+        if page.xml:
+            text = unescape_xml(text)
+    return Page(page.id, page.title, page.namespace, text)
+
+
+def convert_mapped_page(page, keep_sections=False, keep_links=False, stats=False, cleaner=None, budget=None):
+    """convert_page() for a MappedPage, see wikimedia2text.dump.convert_page()"""
+    return convert_page(read_page(page), keep_sections, keep_links, stats=stats, cleaner=cleaner, budget=budget)
+
+
+def convert_mapped(pages, workers=None, batch_size=DEFAULT_BATCH_SIZE, ordered=True,
+                   keep_sections=False, keep_links=False, stats=False, cleaner=None, budget=None):
+    """
+    Convert MappedPages into plain text using several processes, which read
+    the text of the pages from the files themselves.
+    See wikimedia2text.pipeline.convert_pages() for the parameters; there is
+    no cache, which would need the text of every page in this process.
+    :return: a generator of (page_id, title, namespace, cleaned_text) Page tuples
+    """
+    if stats and budget is not None:
+        raise ValueError('stats profile the conversion, they cannot be combined with a budget')
+    func = partial(convert_mapped_page, keep_sections=keep_sections, keep_links=keep_links, stats=stats,
+                   cleaner=cleaner, budget=budget)
+    results = imap_batches(func, pages, workers=workers, batch_size=batch_size, ordered=ordered)
+    if budget is not None:
+        results = _report_exceeded(results, budget.on_exceeded)
+    try:
+        for result in results:
+            yield result
+    finally:
+        # with a single worker the files were mapped by this process
+        close_mappings()
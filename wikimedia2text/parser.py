@@ -48,17 +48,205 @@ The code in this file is heavily inspired and in large part copied from the Wiki
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 # =============================================================================
+import codecs
 import re
-from htmlentitydefs import name2codepoint
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from functools import partial
+from timeit import default_timer as timer
 
+try:
+    from htmlentitydefs import name2codepoint
+except ImportError:  # Python 3
+    from html.entities import name2codepoint
+    unichr = chr
+    xrange = range
 
-def parse(text):
+# Python 2 matches \w, \s, \b and IGNORECASE on ASCII only, keep that on Python 3
+ASCII = getattr(re, 'ASCII', 0)
+
+try:
+    codecs.lookup_error('surrogatepass')
+    _SURROGATES = 'surrogatepass'
+except LookupError:  # Python 2 encodes and decodes surrogates as they are
+    _SURROGATES = 'strict'
+
+
+def encode_utf8(text):
+    """
+    Encode unicode text in utf-8 the way Python 2 does on Python 3 too.
+    Character references such as &#55296; leave surrogates in the text, which
+    Python 3 refuses to encode: a pair is encoded as the character it stands
+    for and a lone surrogate as is, decode_utf8() reads it back.
+    """
+    try:
+        return text.encode('utf-8')
+    except UnicodeEncodeError:
+        text = text.encode('utf-16-le', _SURROGATES).decode('utf-16-le', _SURROGATES)
+        return text.encode('utf-8', _SURROGATES)
+
+
+def decode_utf8(data):
+    """Decode utf-8 written by encode_utf8()"""
+    return data.decode('utf-8', _SURROGATES)
+
+
+def parse(text, keep_sections=False, keep_links=False, placeholders=None, stats=None, cleaner=None):
     """
     Give wikimedia formatted text and transform it into unicode text without any formatting.
-    :param text: wikimedia formatted text
+    :param text: wikimedia formatted text, utf-8 encoded or unicode
+    :param keep_sections: keep section titles and list items as html tags
+    :param keep_links: keep internal links as html anchors
+    :param placeholders: optional list receiving the formulas and code blocks, see clean()
+    :param stats: optional per stage instrumentation, see clean(); compact() is recorded too
+    :param cleaner: the Cleaner profile to clean with, defaults to the module settings
     :return: the "best" unicode representation of the wikimedia text
     """
-    return u"\n".join(compact(clean(text.decode('utf-8'))))
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    return _convert(text, keep_sections, keep_links, placeholders, stats, cleaner)
+
+
+def _convert(text, keep_sections=False, keep_links=False, placeholders=None, stats=None, cleaner=None):
+    """parse() for unicode text"""
+    text = clean(text, keep_links=keep_links, placeholders=placeholders, stats=stats, cleaner=cleaner)
+    if stats is None:
+        return u"\n".join(compact(text, keep_sections=keep_sections))
+    size = len(text)
+    started = timer()
+    page = compact(text, keep_sections=keep_sections)
+    result = u"\n".join(page)
+    stats.record('compact', timer() - started, size, len(result), len(page))
+    return result
+
+
+def parse_iter(text, keep_sections=False, keep_links=False, placeholders=None, cleaner=None):
+    """
+    parse() yielding the paragraphs one at a time instead of joining them, so
+    that large pages can be written out or tokenized as they are laid out.
+    See parse() for the parameters.
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    text = clean(text, keep_links=keep_links, placeholders=placeholders, cleaner=cleaner)
+    return compact_iter(text, keep_sections=keep_sections)
+
+
+ParsedPage = namedtuple('ParsedPage', ['text', 'sections', 'links', 'categories', 'external_links'])
+
+
+def parse_structured(text, keep_sections=False, keep_links=False, placeholders=None, cleaner=None):
+    """
+    parse() also returning the structure of the page, gathered while cleaning it.
+    The links are followed with private use characters, U+E000 to U+F7FF and
+    U+F8FF: these characters are removed from text beforehand, the text
+    returned lacks them where parse() keeps them.  The text can differ from
+    parse() otherwise too, where a link comes right after the start of a tag,
+    e.g. after an unclosed '<' such as a decoded &lt;: the markers change how
+    the tag patterns match there, u'&lt;[[a|b]]<br/>x' gives u'<bx' where
+    parse() gives u'x'.
+    See parse() for the parameters.
+    :return: a ParsedPage of
+        text: the plain text, as parse() returns it but for the cases above
+        sections: (offset, level, title) of the sections kept in text, offset
+            being where their title starts
+        links: (start, end, target) of the internal links, the anchor being text[start:end]
+        categories: names of the categories of the page
+        external_links: urls of the external links
+    """
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    # the marker characters are reserved for the links
+    text = linkMarkers.sub(u'', text)
+    structure = _Structure()
+    text = clean(text, keep_links=keep_links, placeholders=placeholders, structure=structure, cleaner=cleaner)
+
+    sections = []
+    paragraphs = []
+    offset = 0
+    for paragraph in _compactLines(text.split('\n'), keep_sections, structure.sections):
+        if len(structure.sections) > len(sections):
+            # the paragraph is the title of that section
+            level, title = structure.sections[len(sections)]
+            sections.append((offset, level, linkMarkers.sub(u'', title)))
+        paragraphs.append(paragraph)
+        offset += len(paragraph) + 1
+    text = u"\n".join(paragraphs)
+
+    # drop the markers, turning them into link spans and offsets in the plain text
+    links = []
+    markers = []        # positions of the markers in the marked text
+    opened = None       # (start, link number) of the anchor being read
+    number = -1
+    for m in linkMarkers.finditer(text):
+        position = m.start() - len(markers)
+        markers.append(m.start())
+        char = ord(m.group())
+        if char == _LINK_END:
+            if opened is not None:
+                links.append((opened[0], position, structure.targets[opened[1]]))
+                opened = None
+            continue
+        # the number of the link modulo _LINK_IDS, links keep their order
+        number += (char - _LINK_START - number) % _LINK_IDS or _LINK_IDS
+        opened = (position, number) if number < len(structure.targets) else None
+    if markers:
+        text = linkMarkers.sub(u'', text)
+        sections = [(offset - bisect_left(markers, offset), level, title)
+                    for offset, level, title in sections]
+    return ParsedPage(text, sections, links, structure.categories, structure.external_links)
+
+
+class _Structure(object):
+    """What the cleaning gathers for parse_structured()"""
+
+    def __init__(self):
+        self.targets = []           # internal link targets, by link number
+        self.categories = []
+        self.external_links = []
+        self.sections = []          # (level, title) of the sections kept, by compact()
+
+
+def parse_many(texts, keep_sections=False, keep_links=False, paragraphs=False,
+               workers=1, batch_size=None, ordered=True, cleaner=None):
+    """
+    parse() a stream of texts, for callers with many (typically small) documents.
+    :param texts: iterable of utf-8 encoded or unicode wikimedia texts, consumed lazily
+    :param keep_sections: keep section titles and list items as html tags
+    :param keep_links: keep internal links as html anchors
+    :param paragraphs: yield the list of paragraphs from compact() instead of joining them
+    :param workers: number of worker processes, 1 parses in the calling process,
+        None uses every core, see wikimedia2text.pipeline.imap_batches()
+    :param batch_size: number of texts sent to a worker at once
+    :param ordered: with several workers, yield the results in input order
+    :param cleaner: the Cleaner profile to clean with, defaults to the module settings
+    :return: a generator of unicode texts, or of paragraph lists
+    """
+    if workers == 1:
+        return _parse_all(texts, keep_sections, keep_links, paragraphs, cleaner)
+    # imported here, the pipeline depends on this module
+    from wikimedia2text.pipeline import DEFAULT_BATCH_SIZE, imap_batches
+    func = partial(_parse_one, keep_sections=keep_sections, keep_links=keep_links, paragraphs=paragraphs,
+                   cleaner=cleaner)
+    return imap_batches(func, texts, workers=workers, batch_size=batch_size or DEFAULT_BATCH_SIZE, ordered=ordered)
+
+
+def _parse_all(texts, keep_sections, keep_links, paragraphs, cleaner=None):
+    """parse_many() in the calling process, with the stages looked up once"""
+    stages = [stage for name, stage in (clean_stages if cleaner is None else cleaner.stages)]
+    join = u"\n".join
+    for text in texts:
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        for stage in stages:
+            text = stage(text, keep_links, None)[0]
+        page = compact(text, keep_sections=keep_sections)
+        yield page if paragraphs else join(page)
+
+
+def _parse_one(text, keep_sections=False, keep_links=False, paragraphs=False, cleaner=None):
+    """Worker side of parse_many()"""
+    return next(_parse_all((text,), keep_sections, keep_links, paragraphs, cleaner))
 ##
 # Recognize only these namespaces
 # w: Internal links to the Wikipedia
@@ -68,15 +256,19 @@ def parse(text):
 acceptedNamespaces = set(['w', 'wiktionary', 'wikt'])
 
 ##
-# Drop these elements from article text
+# Drop these elements from article text, in this order, which matters for
+# improperly nested ones.  It is the order Python 2 iterated the original set
+# in, and does not depend on hash randomization.
 #
-discardElements = set([
-    'gallery', 'timeline', 'noinclude', 'pre',
-    'table', 'tr', 'td', 'th', 'caption',
-    'form', 'input', 'select', 'option', 'textarea',
-    'ul', 'li', 'ol', 'dl', 'dt', 'dd', 'menu', 'dir',
-    'ref', 'references', 'img', 'imagemap', 'source'
-])
+discardOrder = [
+    'pre', 'references', 'table', 'imagemap', 'select', 'noinclude', 'img', 'caption', 'menu',
+    'tr', 'li', 'source', 'th', 'input', 'td', 'ref', 'dl', 'option', 'form', 'timeline',
+    'dd', 'dt', 'gallery', 'ol', 'textarea', 'ul', 'dir',
+]
+
+# The same elements as a set.  Both are compiled into the default profile at
+# import, use a Cleaner profile to drop other elements.
+discardElements = frozenset(discardOrder)
 
 #=========================================================================
 #
@@ -97,71 +289,195 @@ version = '2.5'
 
 # A matching function for nested expressions, e.g. namespaces and tables.
 def dropNested(text, openDelim, closeDelim):
-    openRE = re.compile(openDelim)
-    closeRE = re.compile(closeDelim)
-    # partition text in separate blocks { } { }
-    matches = []  # pairs (s, e) for each partition
+    return _dropPartitions(text, _nestedSpans(_delimiters(text, openDelim), _delimiters(text, closeDelim)))
+
+
+_delimiter_patterns = {}
+
+
+def _delimiters(text, delim):
+    """(start, end) of every occurrence of delim in text, overlapping ones included"""
+    pattern = _delimiter_patterns.get(delim)
+    if pattern is None:
+        pattern = _delimiter_patterns[delim] = re.compile(r'(?=(%s))' % delim)
+    return [(m.start(), m.end(1)) for m in pattern.finditer(text)]
+
+
+def _nestedSpans(opens, closes):
+    """
+    Partition text in separate blocks { } { }.
+    This is the historical dropNested algorithm, including its handling of
+    unbalanced delimiters, but every search of the text is replaced by a
+    cursor over the sorted delimiter occurrences.  The searches only ever move
+    forward, so the whole partitioning is linear.
+    :param opens: (start, end) of the opening delimiters
+    :param closes: (start, end) of the closing delimiters
+    :return: the (start, end) spans to drop
+    """
+    if not opens:
+        return []
+    nopen = len(opens)
+    nclose = len(closes)
+    spans = []  # pairs (s, e) for each partition
     nest = 0  # nesting level
-    start = openRE.search(text, 0)
-    if not start:
-        return text
-    end = closeRE.search(text, start.end())
-    next = start
+    start = next = opens[0]
+    oi = ci = 0  # cursors on opens and closes
+    while ci < nclose and closes[ci][0] < start[1]:
+        ci += 1
+    end = closes[ci] if ci < nclose else None
     while end:
-        next = openRE.search(text, next.end())
-        if not next:  # termination
+        while oi < nopen and opens[oi][0] < next[1]:
+            oi += 1
+        if oi == nopen:  # termination
             while nest:  # close all pending
                 nest -= 1
-                end0 = closeRE.search(text, end.end())
-                if end0:
-                    end = end0
+                while ci < nclose and closes[ci][0] < end[1]:
+                    ci += 1
+                if ci < nclose:
+                    end = closes[ci]
                 else:
                     break
-            matches.append((start.start(), end.end()))
+            spans.append((start[0], end[1]))
             break
-        while end.end() < next.start():
+        next = opens[oi]
+        while end[1] < next[0]:
             # { } {
             if nest:
                 nest -= 1
                 # try closing more
-                last = end.end()
-                end = closeRE.search(text, end.end())
-                if not end:  # unbalanced
-                    if matches:
-                        span = (matches[0][0], last)
+                last = end[1]
+                while ci < nclose and closes[ci][0] < end[1]:
+                    ci += 1
+                if ci == nclose:  # unbalanced
+                    end = None
+                    if spans:
+                        span = (spans[0][0], last)
                     else:
-                        span = (start.start(), last)
-                    matches = [span]
+                        span = (start[0], last)
+                    spans = [span]
                     break
+                end = closes[ci]
             else:
-                matches.append((start.start(), end.end()))
+                spans.append((start[0], end[1]))
                 # advance start, find next close
                 start = next
-                end = closeRE.search(text, next.end())
+                while ci < nclose and closes[ci][0] < next[1]:
+                    ci += 1
+                end = closes[ci] if ci < nclose else None
                 break  # { }
         if next != start:
             # { { }
             nest += 1
-    # collect text outside partitions
-    res = ''
+    return spans
+
+
+def _dropPartitions(text, spans):
+    """Collect text outside the ascending spans"""
+    if not spans:
+        return text
+    res = []
     start = 0
-    for s, e in matches:
-        res += text[start:s]
+    for s, e in spans:
+        res.append(text[start:s])
         start = e
-    res += text[start:]
-    return res
+    res.append(text[start:])
+    return text[:0].join(res)
+
+
+def _occurrences(text, delim):
+    """(start, end) of every occurrence of a literal delimiter, overlapping ones included"""
+    found = []
+    n = len(delim)
+    i = text.find(delim)
+    while i >= 0:
+        found.append((i, i + n))
+        i = text.find(delim, i + 1)
+    return found
+
+
+def dropTemplatesAndTables(text):
+    """
+    Drop transclusions (templates, parser functions) and tables.
+    The output is the one of dropNested(dropNested(text, r'{{', r'}}'), r'{\\|', r'\\|}'),
+    but the intermediate text is never built: the delimiters of both kinds are
+    located in the original text, the table delimiters are mapped onto what
+    survives the templates, and the result is assembled with a single join.
+    """
+    return _dropPartitions(text, templateAndTableSpans(text))
+
+
+def templateAndTableSpans(text):
+    """The ascending, disjoint (start, end) spans dropped by dropTemplatesAndTables()"""
+    spans = _nestedSpans(_occurrences(text, '{{'), _occurrences(text, '}}'))
+    tableOpens = _occurrences(text, '{|')
+    tableCloses = _occurrences(text, '|}')
+    if not spans:
+        return _nestedSpans(tableOpens, tableCloses)
+
+    # Text surviving the templates: where each piece starts and ends, and where
+    # it starts once the templates are dropped
+    starts, ends, offsets = [], [], []
+    start = offset = 0
+    for s, e in spans + [(len(text), len(text))]:
+        if start < s:
+            starts.append(start)
+            ends.append(s)
+            offsets.append(offset)
+            offset += s - start
+        start = max(start, e)
+
+    # Table delimiters of the remaining text, in its coordinates.  Besides the
+    # surviving ones, dropping a template can join a '{' or '|' with what follows.
+    tableDelimiters = {'{|': [], '|}': []}
+    joined = False
+    for positions, found in ((tableOpens, tableDelimiters['{|']), (tableCloses, tableDelimiters['|}'])):
+        for s, e in positions:
+            k = bisect_right(starts, s) - 1
+            if k >= 0 and e <= ends[k]:
+                p = s - starts[k] + offsets[k]
+                found.append((p, p + 2))
+    for k in xrange(len(starts) - 1):
+        if text[ends[k] - 1] in '{|':
+            found = tableDelimiters.get(text[ends[k] - 1] + text[starts[k + 1]])
+            if found is not None:
+                p = offsets[k + 1] - 1
+                found.append((p, p + 2))
+                joined = True
+    if joined:
+        for found in tableDelimiters.values():
+            found.sort()
+    tableSpans = _nestedSpans(tableDelimiters['{|'], tableDelimiters['|}'])
+    if not tableSpans:
+        return spans
+
+    # Bring the table spans back to the original text and merge everything
+    for s, e in tableSpans:
+        k = bisect_right(offsets, s) - 1
+        s = starts[k] + s - offsets[k]
+        k = bisect_right(offsets, e - 1) - 1
+        e = starts[k] + e - offsets[k]
+        spans.append((s, e))
+    spans.sort()
+    merged = [spans[0]]
+    for s, e in spans[1:]:
+        if s <= merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
 
 
 def dropSpans(matches, text):
     """Drop from text the blocks identified in matches"""
     matches.sort()
-    res = ''
+    res = []
     start = 0
     for s, e in matches:
-        res += text[start:s]
+        res.append(text[start:s])
         start = e
-    res += text[start:]
-    return res
+    res.append(text[start:])
+    return text[:0].join(res)
 
 # Match interwiki links, | separates parameters.
 # First parameter is displayed, also trailing concatenated text included
@@ -170,7 +486,7 @@ def dropSpans(matches, text):
 # Can be nested [[File:..|..[[..]]..|..]], [[Category:...]], etc.
 # We first expand inner ones, than remove enclosing ones.
 #
-wikiLink = re.compile(r'\[\[([^[]*?)(?:\|([^[]*?))?\]\](\w*)')
+wikiLink = re.compile(r'\[\[([^[]*?)(?:\|([^[]*?))?\]\](\w*)', ASCII)
 
 parametrizedLink = re.compile(r'\[\[.*?\]\]')
 
@@ -178,8 +494,8 @@ parametrizedLink = re.compile(r'\[\[.*?\]\]')
 comment = re.compile(r'<!--.*?-->', re.DOTALL)
 
 # Match external links (space separates second optional parameter)
-externalLink = re.compile(r'\[\w+.*? (.*?)\]')
-externalLinkNoAnchor = re.compile(r'\[\w+[&\]]*\]')
+externalLink = re.compile(r'\[(\w+.*?) (.*?)\]', ASCII)
+externalLinkNoAnchor = re.compile(r'\[\w+[&\]]*\]', ASCII)
 
 # Titles
 title = re.compile
@@ -191,12 +507,28 @@ italic_quote = re.compile(r"''\"(.*?)\"''")
 italic = re.compile(r"''([^']*)''")
 quote_quote = re.compile(r'""(.*?)""')
 
+emphasis_patterns = [
+    (bold_italic, r'\1'),
+    (bold, r'\1'),
+    (italic_quote, r'&quot;\1&quot;'),
+    (italic, r'&quot;\1&quot;'),
+    (quote_quote, r'\1'),
+]
+
 # Matches space
 spaces = re.compile(r' {2,}')
 
 # Matches dots
 dots = re.compile(r'\.{4,}')
 
+cleanup_patterns = [
+    (spaces, ' '),
+    (dots, '...'),
+    (re.compile(r' (,:\.\)\]\xbb)'), r'\1'),
+    (re.compile(r'(\[\(\xab) '), r'\1'),
+    (re.compile(r'\n\W+?\n', ASCII), '\n'),  # lines with only punctuations
+]
+
 selfClosingTags = ['br', 'hr', 'nobr', 'ref', 'references']
 
 # handle 'a' separetely, depending on keepLinks
@@ -211,34 +543,67 @@ placeholder_tags = {'math': 'formula', 'code': 'codice'}
 
 
 # Match elements to ignore
-discard_element_patterns = [re.compile(r'<\s*%s\b[^>]*>.*?<\s*/\s*%s>' % (tag, tag), re.DOTALL | re.IGNORECASE) for tag in discardElements]
+def discardElement(tag):
+    return re.compile(r'<\s*%s\b[^>]*>.*?<\s*/\s*%s>' % (tag, tag), re.DOTALL | re.IGNORECASE | ASCII)
 
 
 # Match ignored tags
 def ignoreTag(tag):
-    left = re.compile(r'<\s*%s\b[^>]*>' % tag, re.IGNORECASE)
-    right = re.compile(r'<\s*/\s*%s>' % tag, re.IGNORECASE)
+    left = re.compile(r'<\s*%s\b[^>]*>' % tag, re.IGNORECASE | ASCII)
+    right = re.compile(r'<\s*/\s*%s>' % tag, re.IGNORECASE | ASCII)
     return left, right
 
-ignored_tag_patterns = [ignoreTag(tag) for tag in ignoredTags]
-
 
 # Match selfClosing HTML tags
-selfClosing_tag_patterns = [re.compile(r'<\s*%s\b[^/]*/\s*>' % tag, re.DOTALL | re.IGNORECASE) for tag in selfClosingTags]
+def selfClosingTag(tag):
+    return re.compile(r'<\s*%s\b[^/]*/\s*>' % tag, re.DOTALL | re.IGNORECASE | ASCII)
+
+
+# Match the start of an HTML comment, or of a tag with its name
+tagStart = re.compile(r'<(?:(!--)|(\s*/)?\s*(\w+))', ASCII)
+
+# Match the name of an opening tag
+openingTagName = re.compile(r'<\s*(\w+)', ASCII)
+
+# Match the start of a tag cut short by another tag, which dropping the
+# other tag would let what follows complete
+brokenTagStart = re.compile(r'<\s*/?\s*\w*<', ASCII)
+
+
+def indexTagPatterns(self_closing=selfClosingTags, ignored=ignoredTags, discarded=discardOrder):
+    """
+    Index the tag patterns by lower-cased tag name, so that the patterns that
+    can match at the start of a tag are looked up rather than all tried.
+    :return: patterns for <tag ...> and <tag .../>, patterns for </tag>, and the
+        (tag, pattern) of the discarded elements, in the order they are applied
+    """
+    opening = {}
+    closing = {}
+    for tag in self_closing:
+        opening.setdefault(tag.lower(), []).append(selfClosingTag(tag))
+    for tag in ignored:
+        left, right = ignoreTag(tag)
+        opening.setdefault(tag.lower(), []).append(left)
+        closing.setdefault(tag.lower(), []).append(right)
+    discarded = [(tag.lower(), discardElement(tag)) for tag in discarded]
+    return opening, closing, discarded
 
 
 # Match HTML placeholder tags
-placeholder_tag_patterns = [(re.compile(r'<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE), repl) for tag, repl in placeholder_tags.items()]
+def placeholderTagPatterns(tags):
+    """(pattern, placeholder) for a {tag: placeholder} dict, in tag order"""
+    return [(re.compile(r'<\s*%s(\s*| [^>]+?)>(.*?)<\s*/\s*%s\s*>' % (tag, tag), re.DOTALL | re.IGNORECASE | ASCII), repl)
+            for tag, repl in sorted(tags.items())]
 
 # Match preformatted lines
 preformatted = re.compile(r'^ .*?$', re.MULTILINE)
 
 
 # Function applied to wikiLinks
-def make_anchor_tag(match, keep_links=False):
+def make_anchor_tag(match, keep_links=False, namespaces=None):
     link = match.group(1)
     colon = link.find(':')
-    if colon > 0 and link[:colon] not in acceptedNamespaces:
+    if colon > 0 and link[:colon] not in (acceptedNamespaces if namespaces is None else namespaces):
         return ''
     trail = match.group(3)
     anchor = match.group(2)
@@ -251,92 +616,462 @@ def make_anchor_tag(match, keep_links=False):
         return anchor
 
 
-def clean(text):
-    # FIXME: templates should be expanded
-    # Drop transclusions (template, parser functions)
-    # See: http://www.mediawiki.org/wiki/Help:Templates
-    text = dropNested(text, r'{{', r'}}')
+##
+# Internal links are tracked through the cleaning by wrapping their anchor in
+# private use characters: a start marker numbering the link (modulo _LINK_IDS)
+# and an end marker.
+#
+_LINK_START = 0xE000
+_LINK_IDS = 0x1800
+_LINK_END = 0xF8FF
+linkMarkers = re.compile(u'[\ue000-\uf7ff\uf8ff]')
 
-    # Drop tables
-    text = dropNested(text, r'{\|', r'\|}')
+# Namespaces of category links, [[Category:Name|sort key]]
+categoryNamespaces = set(['Category', 'category'])
 
-    # Expand links
-    text = wikiLink.sub(make_anchor_tag, text)
-    # Drop all remaining ones
-    text = parametrizedLink.sub('', text)
 
-    # Handle external links
-    text = externalLink.sub(r'\1', text)
-    text = externalLinkNoAnchor.sub('', text)
+def _markedAnchorTag(match, keep_links, structure, cleaner):
+    """make_anchor_tag() recording the link in structure, with its anchor between markers"""
+    link = match.group(1)
+    colon = link.find(':')
+    if colon > 0 and link[:colon] not in cleaner.accepted_namespaces:
+        if link[:colon] in cleaner.category_namespaces:
+            structure.categories.append(link[colon + 1:].strip())
+        return ''
+    anchor = (match.group(2) or link) + match.group(3)
+    # keep the spaces and quotes around the anchor outside, they still go
+    # through the cleanup and emphasis as they would without markers
+    core = anchor.strip(" '")
+    if core:
+        start = anchor.find(core)
+        anchor = u'%s%s%s%s%s' % (anchor[:start], unichr(_LINK_START + len(structure.targets) % _LINK_IDS),
+                                  core, unichr(_LINK_END), anchor[start + len(core):])
+        structure.targets.append(link.strip())
+    if keep_links:
+        return '<a href="%s">%s</a>' % (link, anchor)
+    return anchor
 
-    # Handle bold/italic/quote
-    text = bold_italic.sub(r'\1', text)
-    text = bold.sub(r'\1', text)
-    text = italic_quote.sub(r'&quot;\1&quot;', text)
-    text = italic.sub(r'&quot;\1&quot;', text)
-    text = quote_quote.sub(r'\1', text)
-    text = text.replace("'''", '').replace("''", '&quot;')
 
-    ################ Process HTML ###############
+def dropTags(text):
+    """
+    Drop HTML comments, self-closing tags, ignored tags and discarded elements.
+    Rather than scanning the text once per tag pattern, the comments and tags are
+    visited in a single scan, and at each of them only the patterns for that tag
+    name are tried.  The result is the same as running every pattern over the text.
+    """
+    return _tagsStage(text, False, None)[0]
 
-    # turn into HTML
-    text = unescape(text)
-    # do it again (&amp;nbsp;)
-    text = unescape(text)
 
+def _tagsStage(text, keep_links, placeholders, cleaner=None):
+    if cleaner is None:
+        cleaner = defaultCleaner
+    opening_tag_patterns = cleaner.opening_tag_patterns
+    closing_tag_patterns = cleaner.closing_tag_patterns
     # Collect spans
-
     matches = []
-    # Drop HTML comments
-    for m in comment.finditer(text):
-        matches.append((m.start(), m.end()))
-
-    # Drop self-closing tags
-    for pattern in selfClosing_tag_patterns:
-        for m in pattern.finditer(text):
-            matches.append((m.start(), m.end()))
-
-    # Drop ignored tags
-    for left, right in ignored_tag_patterns:
-        for m in left.finditer(text):
-            matches.append((m.start(), m.end()))
-        for m in right.finditer(text):
-            matches.append((m.start(), m.end()))
+    last = {}  # end of the last match of each pattern, as its matches never overlap
+    names = set()  # of the opening tags
+    for m in tagStart.finditer(text):
+        start = m.start()
+        if m.group(1):
+            patterns = (comment,)
+        else:
+            name = m.group(3).lower()
+            if m.group(2):
+                patterns = closing_tag_patterns.get(name, ())
+            else:
+                names.add(name)
+                patterns = opening_tag_patterns.get(name, ())
+        for pattern in patterns:
+            if start >= last.get(pattern, 0):
+                match = pattern.match(text, start)
+                if match:
+                    matches.append((start, match.end()))
+                    last[pattern] = match.end()
+
+    # Every span starts with '<', so dropping them can only join the pieces of
+    # a tag into a new one where the text has the start of a tag cut short
+    joins = brokenTagStart.search(text)
 
     # Bulk remove all spans
+    count = len(matches)
     text = dropSpans(matches, text)
 
     # Cannot use dropSpan on these since they may be nested
-    # Drop discarded elements
-    for pattern in discard_element_patterns:
-        text = pattern.sub('', text)
+    # Drop discarded elements, skipping those absent from the text, and
+    # looking again after each drop that may have joined new ones
+    if joins and count:
+        names = _openingTagNames(text)
+    for tag, pattern in cleaner.discarded_tag_patterns:
+        if tag in names:
+            text, n = pattern.subn('', text)
+            count += n
+            if joins and n:
+                names = _openingTagNames(text)
+    return text, count
+
 
-    # Expand placeholders
-    for pattern, placeholder in placeholder_tag_patterns:
-        index = 1
-        for match in pattern.finditer(text):
-            text = text.replace(match.group(), '%s_%d' % (placeholder, index))
-            index += 1
+def _openingTagNames(text):
+    """The lower-cased names of the opening tags in text"""
+    return set(name.lower() for name in set(openingTagName.findall(text)))
 
-    text = text.replace('<<', u'«').replace('>>', u'»')
 
-    #############################################
+def expandPlaceholders(text, placeholders=None):
+    """
+    Replace <math> and <code> blocks by numbered placeholders (formula_1, codice_1, ...).
+    Each kind is replaced in a single substitution; identical blocks share the
+    placeholder of their first occurrence, while the numbering still counts them.
+    :param placeholders: if a list is given, a (placeholder, body) pair is appended
+        for every placeholder introduced
+    """
+    return _placeholdersStage(text, False, placeholders)[0]
+
+
+def _placeholdersStage(text, keep_links, placeholders, cleaner=None):
+    if cleaner is None:
+        cleaner = defaultCleaner
+    count = 0
+    for pattern, placeholder in cleaner.placeholder_tag_patterns:
+        if '<' not in text:
+            break
+        index = [0]
+        seen = {}
+        nested = []
+        introduced = len(placeholders) if placeholders is not None else 0
+
+        def replace(match):
+            index[0] += 1
+            block = match.group()
+            if block.count('<') > 2 and pattern.search(block, 1):
+                nested.append(block)
+            name = seen.get(block)
+            if name is None:
+                name = seen[block] = '%s_%d' % (placeholder, index[0])
+                if placeholders is not None:
+                    placeholders.append((name, match.group(2)))
+            return name
+
+        expanded = pattern.sub(replace, text)
+        if nested:
+            # a block may also occur inside another one, which replacing the
+            # blocks one after the other everywhere in the text turns out differently
+            if placeholders is not None:
+                del placeholders[introduced:]
+            expanded = _replaceInTurn(pattern, placeholder, text, placeholders)
+        text = expanded
+        count += index[0]
+    return text, count
+
+
+def _replaceInTurn(pattern, placeholder, text, placeholders):
+    """Replace every block matched in text by its placeholder wherever it occurs, one block at a time"""
+    expanded = text
+    for index, match in enumerate(pattern.finditer(text), 1):
+        block = match.group()
+        if block in expanded:
+            name = '%s_%d' % (placeholder, index)
+            expanded = expanded.replace(block, name)
+            if placeholders is not None:
+                placeholders.append((name, match.group(2)))
+    return expanded
+
+
+def expandLinks(text, keep_links=False):
+    """Expand internal links into their anchor, drop the remaining ones and external links"""
+    return _linksStage(text, keep_links, None)[0]
+
+
+def _linksStage(text, keep_links, placeholders, structure=None, cleaner=None):
+    if cleaner is None:
+        cleaner = defaultCleaner
+    # Expand links
+    if structure is None:
+        namespaces = cleaner.accepted_namespaces
+        text, count = wikiLink.subn(lambda m: make_anchor_tag(m, keep_links, namespaces), text)
+    else:
+        text, count = wikiLink.subn(lambda m: _markedAnchorTag(m, keep_links, structure, cleaner), text)
+    # Drop all remaining ones
+    text, n = parametrizedLink.subn('', text)
+    count += n
+
+    # Handle external links
+    if structure is None:
+        text, n = externalLink.subn(r'\2', text)
+    else:
+        def anchor(m):
+            structure.external_links.append(m.group(1))
+            return m.group(2)
+        text, n = externalLink.subn(anchor, text)
+    count += n
+    text, n = externalLinkNoAnchor.subn('', text)
+    return text, count + n
+
+
+def dropEmphasis(text):
+    """Handle bold/italic/quote"""
+    return _emphasisStage(text, False, None)[0]
+
+
+def _emphasisStage(text, keep_links, placeholders):
+    count = 0
+    for pattern, repl in emphasis_patterns:
+        text, n = pattern.subn(repl, text)
+        count += n
+    return text.replace("'''", '').replace("''", '&quot;'), count
+
+
+def unescapeNested(text):
+    """
+    Decode the entities of text, including doubly escaped ones (&amp;nbsp;).
+    Same as unescape(unescape(text)), in a single scan in all but contrived cases.
+    """
+    return _unescapeStage(text, False, None)[0]
+
+
+def _unescapeStage(text, keep_links, placeholders):
+    # turn into HTML, &amp;nbsp; and the like are decoded in the same scan
+    if '&' not in text:
+        return text, 0
+    unsure = []
+
+    def decode(m):
+        char = entityTable.get(m.group())
+        if char is not None:
+            return char
+        escaped, numeric, code = m.groups()
+        char = _decodeEntity(numeric, code)
+        if escaped:
+            # what a second unescape() makes of the &code; left by the first one
+            return u'&' + numeric + code + u';' if char is None else char
+        if char is None:
+            return m.group(0)
+        if char in entityJoining or (char == u'&' and entityJoin.match(text, m.end())):
+            unsure.append(m.start())
+        return char
+
+    result, count = nestedEntity.subn(decode, text)
+    if unsure:
+        # a decoded character may form a new entity with its neighbours
+        # (&amp;&#110;bsp;), leave that to two plain passes
+        result, count = entity.subn(fixup_entity, text)
+        result, n = entity.subn(fixup_entity, result)
+        count += n
+    return result, count
+
+
+def cleanupText(text):
+    """Drop preformatted lines, normalize spaces and punctuation"""
+    return _cleanupStage(text, False, None)[0]
+
+
+def _cleanupStage(text, keep_links, placeholders):
+    text = text.replace('<<', u'\xab').replace('>>', u'\xbb')
 
     # Drop preformatted
     # This can't be done before since it may remove tags
-    text = preformatted.sub('', text)
+    text, count = preformatted.subn('', text)
 
     # Cleanup text
     text = text.replace('\t', ' ')
-    text = spaces.sub(' ', text)
-    text = dots.sub('...', text)
-    text = re.sub(u' (,:\.\)\]»)', r'\1', text)
-    text = re.sub(u'(\[\(«) ', r'\1', text)
-    text = re.sub(r'\n\W+?\n', '\n', text) # lines with only punctuations
+    for pattern, repl in cleanup_patterns:
+        text, n = pattern.subn(repl, text)
+        count += n
     text = text.replace(',,', ',').replace(',.', '.')
+    return text, count
+
+
+def _templatesStage(text, keep_links, placeholders):
+    spans = templateAndTableSpans(text)
+    return _dropPartitions(text, spans), len(spans)
+
+
+##
+# The stages of clean(), in order, as (name, function).  The functions take the
+# text, keep_links and placeholders, and return the new text with the number of
+# matches they handled.
+#
+clean_stages = [
+    # FIXME: templates should be expanded
+    # Drop transclusions (template, parser functions) and tables
+    # See: http://www.mediawiki.org/wiki/Help:Templates
+    ('templates', _templatesStage),
+    ('links', _linksStage),
+    ('emphasis', _emphasisStage),
+    ('unescape', _unescapeStage),
+    # Drop HTML comments, self-closing tags, ignored tags and discarded elements
+    ('tags', _tagsStage),
+    ('placeholders', _placeholdersStage),
+    ('cleanup', _cleanupStage),
+]
+
+
+def clean(text, keep_links=False, placeholders=None, stats=None, structure=None, cleaner=None):
+    """
+    Remove the wikimedia markup from text.
+    :param text: unicode wikimedia text
+    :param keep_links: keep internal links as html anchors
+    :param placeholders: if a list is given, the (placeholder, body) of every
+        formula and code block replaced by a placeholder is appended to it
+    :param stats: optional object whose record(stage, seconds, size_in, size_out, matches)
+        is called after every stage, see wikimedia2text.stats.PageStats
+    :param structure: used by parse_structured() to collect links and categories
+    :param cleaner: the Cleaner profile to clean with, defaults to the module settings
+    :return: the text, still to be laid out by compact()
+    """
+    stages = clean_stages if cleaner is None else cleaner.stages
+    if structure is not None:
+        stages = [(name, partial(_linksStage, structure=structure, cleaner=cleaner) if name == 'links' else stage)
+                  for name, stage in stages]
+    if stats is None:
+        for name, stage in stages:
+            text = stage(text, keep_links, placeholders)[0]
+        return text
+    for name, stage in stages:
+        size = len(text)
+        started = timer()
+        text, matches = stage(text, keep_links, placeholders)
+        stats.record(name, timer() - started, size, len(text), matches)
     return text
 
 
+class Cleaner(object):
+    """
+    A cleaning profile: the elements, tags and namespaces clean() deals with,
+     compiled into patterns once.  Profiles are independent of each other and
+     of the module settings, which are their defaults.  The exception is
+     acceptedNamespaces, which clean() always read on every call: the profiles
+     made without accepted_namespaces, the default one included, follow it.
+
+        german = Cleaner(category_namespaces=['Kategorie', 'kategorie'])
+        page = german.parse_structured(wikitext)
+
+    A profile is pickled as its settings only, and compiled at most once per
+     process when it is unpickled, so handing it to worker processes is cheap.
+    :param discard_elements: elements dropped with their content, in the order
+        they are dropped (a set is sorted)
+    :param ignored_tags: tags dropped, keeping their content
+    :param self_closing_tags: self-closing tags dropped
+    :param placeholder_tags: {tag: placeholder} of the blocks replaced by
+        numbered placeholders, see expandPlaceholders()
+    :param accepted_namespaces: namespaces (or interwiki prefixes) of the
+        internal links kept, links to any other namespace are dropped
+    :param category_namespaces: namespaces of the category links, reported by
+        parse_structured(); namespaces are matched as written, so list every spelling
+    """
+
+    def __init__(self, discard_elements=None, ignored_tags=None, self_closing_tags=None,
+                 placeholder_tags=None, accepted_namespaces=None, category_namespaces=None):
+        self.discard_elements = _settings(discard_elements, discardOrder)
+        self.ignored_tags = _settings(ignored_tags, ignoredTags)
+        self.self_closing_tags = _settings(self_closing_tags, selfClosingTags)
+        self.placeholder_tags = dict(_placeholderTags if placeholder_tags is None else placeholder_tags)
+        self._accepted_namespaces = None if accepted_namespaces is None else frozenset(accepted_namespaces)
+        self.category_namespaces = frozenset(_settings(category_namespaces, categoryNamespaces))
+        self._signature = None      # settings and the signature of these settings
+
+        self.opening_tag_patterns, self.closing_tag_patterns, self.discarded_tag_patterns = \
+            indexTagPatterns(self.self_closing_tags, self.ignored_tags, self.discard_elements)
+        self.placeholder_tag_patterns = placeholderTagPatterns(self.placeholder_tags)
+        self.stages = [(name, partial(stage, cleaner=self) if stage in _profiledStages else stage)
+                       for name, stage in clean_stages]
+
+    @property
+    def accepted_namespaces(self):
+        """The namespaces of the internal links kept, acceptedNamespaces unless given"""
+        if self._accepted_namespaces is None:
+            return acceptedNamespaces
+        return self._accepted_namespaces
+
+    @property
+    def settings(self):
+        """The arguments the profile stands for, as a hashable tuple"""
+        return (self.discard_elements, self.ignored_tags, self.self_closing_tags,
+                tuple(sorted(self.placeholder_tags.items())),
+                tuple(sorted(self.accepted_namespaces)), tuple(sorted(self.category_namespaces)))
+
+    @property
+    def signature(self):
+        """Text identifying the settings, empty for the defaults, see wikimedia2text.cache"""
+        settings = self.settings
+        if self._signature is None or self._signature[0] != settings:
+            if settings == _defaultSettings:
+                signature = u''
+            else:
+                signature = u';'.join(
+                    u','.join(u'='.join(item) if isinstance(item, tuple) else item for item in part)
+                    for part in settings)
+            self._signature = settings, signature
+        return self._signature[1]
+
+    def __reduce__(self):
+        return _cleaner, (self.settings if self.signature else None,)
+
+    def clean(self, text, keep_links=False, placeholders=None, stats=None):
+        """clean() with this profile"""
+        return clean(text, keep_links, placeholders, stats, cleaner=self)
+
+    def compact(self, text, keep_sections=False):
+        """compact(), which does not depend on the profile"""
+        return compact(text, keep_sections)
+
+    def parse(self, text, keep_sections=False, keep_links=False, placeholders=None, stats=None):
+        """parse() with this profile"""
+        return parse(text, keep_sections, keep_links, placeholders, stats, cleaner=self)
+
+    def parse_iter(self, text, keep_sections=False, keep_links=False, placeholders=None):
+        """parse_iter() with this profile"""
+        return parse_iter(text, keep_sections, keep_links, placeholders, cleaner=self)
+
+    def parse_structured(self, text, keep_sections=False, keep_links=False, placeholders=None):
+        """parse_structured() with this profile"""
+        return parse_structured(text, keep_sections, keep_links, placeholders, cleaner=self)
+
+    def parse_many(self, texts, keep_sections=False, keep_links=False, paragraphs=False,
+                   workers=1, batch_size=None, ordered=True):
+        """parse_many() with this profile"""
+        return parse_many(texts, keep_sections, keep_links, paragraphs, workers, batch_size, ordered, cleaner=self)
+
+
+# The stages depending on the profile, given it as their cleaner argument
+_profiledStages = (_tagsStage, _placeholdersStage, _linksStage)
+
+
+# placeholder_tags, which Cleaner() arguments shadow
+_placeholderTags = placeholder_tags
+
+
+def _settings(values, default):
+    """A tuple of the given settings, or of the default ones; sets are sorted"""
+    if values is None:
+        values = default
+    if isinstance(values, (set, frozenset)):
+        return tuple(sorted(values))
+    return tuple(values)
+
+
+# Profiles unpickled in this process, by settings
+_cleaners = {}
+
+
+def _cleaner(settings):
+    """Unpickle a Cleaner, compiling it only the first time its settings are seen"""
+    if settings is None:
+        return defaultCleaner
+    cleaner = _cleaners.get(settings)
+    if cleaner is None:
+        discard, ignored, self_closing, placeholders, accepted, categories = settings
+        cleaner = _cleaners[settings] = Cleaner(discard, ignored, self_closing, dict(placeholders),
+                                                accepted, categories)
+    return cleaner
+
+
+# The profile of the module settings
+defaultCleaner = Cleaner()
+
+# Its settings at import, which have an empty signature
+_defaultSettings = defaultCleaner.settings
+
+
 ##
 # Removes HTML or XML character references and entities from a text string.
 #
@@ -344,81 +1079,166 @@ def clean(text):
 # @return The plain text, as a Unicode string, if necessary.
 
 def unescape(text):
-    def fixup(m):
-        text = m.group(0)
-        code = m.group(1)
-        try:
-            if text[1] == "#":  # character reference
-                if text[2] == "x":
-                    return unichr(int(code[1:], 16))
-                else:
-                    return unichr(int(code))
-            else:  # named entity
-                return unichr(name2codepoint[code])
-        except:
-            return text  # leave as is
+    return entity.sub(fixup_entity, text)
 
-    return re.sub("&#?(\w+);", fixup, text)
+entity = re.compile(r"&#?(\w+);", ASCII)
 
-section = re.compile(r'(==+)\s*(.*?)\s*\1')
+# An entity, possibly behind an escaped ampersand (&amp;, &#38;, &#x26;)
+nestedEntity = re.compile(r"&(amp;|#0*38;|#x0*26;)?(#?)(\w+);", ASCII)
+
+# Decoded characters that may form an entity with the text around them
+entityJoining = frozenset(u'#;_0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+# What a second unescape() decodes behind an ampersand decoded by the first one
+entityJoin = re.compile(r"#?\w+;", ASCII)
+
+namedEntities = dict((name, unichr(code)) for name, code in name2codepoint.items())
+
+
+def _entityTable():
+    """
+    The decoded character of the usual entities, as matched by nestedEntity,
+    leaving out those decoding to characters that may form a new entity.
+    """
+    table = {}
+    for name, code in name2codepoint.items():
+        char = unichr(code)
+        table[u'&amp;%s;' % name] = char
+        if char != u'&' and char not in entityJoining:
+            table[u'&%s;' % name] = char
+            table[u'&#%d;' % code] = char
+            table[u'&amp;#%d;' % code] = char
+    for code in range(32, 127):
+        char = unichr(code)
+        if char != u'&' and char not in entityJoining:
+            table[u'&#%d;' % code] = char
+            table[u'&amp;#%d;' % code] = char
+    return table
+
+entityTable = _entityTable()
+
+
+def _decodeEntity(numeric, code):
+    """The character of an entity, None if it is not a valid one"""
+    if not numeric:
+        return namedEntities.get(code)
+    if '_' in code:
+        return None     # int() takes digit separators on Python 3
+    try:
+        if code[0] == 'x':
+            return unichr(int(code[1:], 16))
+        return unichr(int(code))
+    except (ValueError, OverflowError):
+        return None
+
+
+def fixup_entity(m):
+    text = m.group(0)
+    char = _decodeEntity(text[1] == '#', m.group(1))
+    if char is None:
+        return text  # leave as is
+    return char
+
+section = re.compile(r'(==+)\s*(.*?)\s*\1', ASCII)
 
 def compact(text, keep_sections=False):
     """Deal with headers, lists, empty sections, residuals of tables"""
-    page = []                   # list of paragraph
+    return list(_compactLines(text.split('\n'), keep_sections))
+
+
+def compact_iter(text, keep_sections=False):
+    """
+    compact() as a generator: paragraphs are yielded as soon as they are
+    complete, and the lines of text are cut one at a time rather than all upfront.
+    """
+    return _compactLines(_iterLines(text), keep_sections)
+
+
+def _iterLines(text):
+    start = 0
+    end = text.find('\n')
+    while end >= 0:
+        yield text[start:end]
+        start = end + 1
+        end = text.find('\n', start)
+    yield text[start:]
+
+
+def _markedSlice(marked, start, stop):
+    """marked[start:stop], counting only the characters that are not link markers"""
+    positions = [i for i, c in enumerate(marked) if not linkMarkers.match(c)]
+    start, stop, step = slice(start, stop).indices(len(positions))
+    if stop <= start:
+        return u''
+    return marked[positions[start - 1] + 1 if start else 0:positions[stop] if stop < len(positions) else len(marked)]
+
+
+def _compactLines(lines, keep_sections, sections=None):
+    """
+    compact() over an iterable of lines.
+    :param sections: for parse_structured(), whose lines carry link markers:
+        the (level, title) of a section is appended right before its title is yielded
+    """
     headers = {}                # Headers for unfilled sections
+    titles = {}                 # Their titles, for sections
     empty_section = False        # empty sections are discarded
 
-    for line in text.split('\n'):
+    for line in lines:
+        # decide on the text without the link markers
+        bare = line if sections is None else linkMarkers.sub(u'', line)
 
-        if not line:
+        if not bare:
             continue
         # Handle section titles
-        m = section.match(line)
+        m = section.match(bare)
         if m:
+            if bare is not line:
+                m = section.match(line) or m
             title = m.group(2)
             lev = len(m.group(1))
             if keep_sections:
-                page.append("<h%d>%s</h%d>" % (lev, title, lev))
-            if title and title[-1] not in '!?':
+                yield "<h%d>%s</h%d>" % (lev, title, lev)
+            titles[lev] = title
+            if title and (title if bare is line else linkMarkers.sub(u'', title))[-1] not in '!?':
                 title += '.'
             headers[lev] = title
             # drop previous headers
-            for i in headers.keys():
+            for i in list(headers):
                 if i > lev:
                     del headers[i]
             empty_section = True
             continue
         # Handle page title
-        if line.startswith('++'):
-            title = line[2:-2]
+        if bare.startswith('++'):
+            title = bare[2:-2]
             if title:
-                if title[-1] not in '!?':
+                last = title[-1]
+                if bare is not line:
+                    title = _markedSlice(line, 2, -2)
+                if last not in '!?':
                     title += '.'
-                page.append(title)
+                yield title
         # handle lists
-        elif line[0] in '*#:;':
+        elif bare[0] in '*#:;':
             if keep_sections:
-                page.append("<li>%s</li>" % line[1:])
+                yield "<li>%s</li>" % (line[1:] if bare is line else _markedSlice(line, 1, None))
             else:
                 continue
         # Drop residuals of lists
-        elif line[0] in '{|' or line[-1] in '}':
+        elif bare[0] in '{|' or bare[-1] in '}':
             continue
         # Drop irrelevant lines
-        elif (line[0] == '(' and line[-1] == ')') or line.strip('.-') == '':
+        elif (bare[0] == '(' and bare[-1] == ')') or bare.strip('.-') == '':
             continue
         elif len(headers):
-            items = headers.items()
-            items.sort()
-            for (i, v) in items:
-                page.append(v)
+            for (i, v) in sorted(headers.items()):
+                if sections is not None:
+                    sections.append((i, titles[i]))
+                yield v
             headers.clear()
-            page.append(line)   # first line
+            yield line   # first line
             empty_section = False
         elif not empty_section:
-            page.append(line)
-
-    return page
+            yield line
 
 
 if __name__ == '__main__':
@@ -448,4 +1268,4 @@ The central tendency of anarchism as a social movement has been represented by [
 The term ''[[wikt:anarchism|anarchism]]'' is a compound word composed from the word ''[[anarchy]]'' and the suffix ''[[-ism]]'',&lt;ref&gt;[http://www.etymonline.com/index.php?term=anarchism&amp;allowed_in_frame=0 Anarchism], [[Online etymology dictionary]].&lt;/ref&gt; themselves derived respectively from the Greek {{lang|grc|ἀναρχία}}, i.e. ''anarchy''&lt;ref&gt;{{LSJ|a)narxi/a|ἀναρχία|ref}}.&lt;/ref&gt;&lt;ref&gt;[http://www.merriam-webster.com/dictionary/anarchy Anarchy], [[Merriam-Webster]] online.&lt;/ref&gt;&lt;ref&gt;[http://www.etymonline.com/index.php?term=anarchy&amp;allowed_in_frame=0 Anarchy], [[Online etymology dictionary]].&lt;/ref&gt; (from {{lang|grc|ἄναρχος}}, ''anarchos'', meaning &quot;one without rulers&quot;;&lt;ref&gt;{{LSJ|a)/narxos|ἄναρχος|ref}}.&lt;/ref&gt; from the [[privative]] prefix [[privative alpha|ἀν]]- (''an-'', i.e. &quot;without&quot;) and {{lang|grc|ἀρχός}}, ''archos'', i.e. &quot;leader&quot;, &quot;ruler&quot;;&lt;ref&gt;{{LSJ|a)rxo/s|ἀρχός|ref}}&lt;/ref&gt; (cf. ''[[ar:
 """
     txt2 = parse(txt)
-    print txt2
+    print(txt2)
@@ -0,0 +1,239 @@
+"""
+Multi-core conversion of dumps.
+
+The reading side (decompression and XML parsing) runs in the calling process
+ and cuts the pages into batches.  The batches are cleaned by a pool of worker
+ processes, and the results are handed back either in dump order or in
+ completion order.  The number of batches in flight is bounded, so a fast
+ reader cannot run ahead of the workers and fill up memory.
+"""
+import multiprocessing
+import sys
+import traceback
+from functools import partial
+try:
+    from Queue import Empty, Queue
+except ImportError:  # Python 3
+    from queue import Empty, Queue
+
+from wikimedia2text.dump import convert_page, iter_raw_pages
+
+
+# Pages handed to a worker at once
+DEFAULT_BATCH_SIZE = 64
+
+# Seconds between checks that the workers are alive while waiting for a batch
+_POLL_SECONDS = 1
+
+
+def batched(items, batch_size):
+    """Group an iterable into lists of at most batch_size items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _run_batch(func, seq, batch):
+    """Worker side: apply func to a batch, shipping errors back as text"""
+    try:
+        return seq, [func(item) for item in batch], None
+    except Exception:
+        return seq, None, traceback.format_exc()
+
+
+def _failed(done, seq, error):
+    """Pool side: report a batch the pool could not run, e.g. as its items or results cannot be pickled"""
+    done.put((seq, None, _describe(error)))
+
+
+def _describe(error):
+    return ''.join(traceback.format_exception_only(type(error), error))
+
+
+def imap_batches(func, items, workers=None, batch_size=DEFAULT_BATCH_SIZE, ordered=True, max_pending=None):
+    """
+    Apply func to every item on a pool of processes.
+    :param func: a picklable function taking one item
+    :param items: any iterable, consumed lazily
+    :param workers: number of worker processes, defaults to the number of cores;
+        with a single worker everything runs in the calling process
+    :param batch_size: number of items sent to a worker at once
+    :param ordered: yield the results in input order, otherwise as soon as they are ready
+    :param max_pending: maximum number of batches submitted but not yet yielded,
+        defaults to four per worker
+    :return: a generator of func(item)
+    """
+    workers = workers or multiprocessing.cpu_count()
+    if workers == 1:
+        for item in items:
+            yield func(item)
+        return
+    max_pending = max_pending or 4 * workers
+
+    done = Queue()
+    ready = {}          # results received ahead of their turn (ordered mode)
+    pending = {}        # seq -> AsyncResult of the batches not received yet
+    pool = multiprocessing.Pool(workers)
+    pids = _worker_pids(pool)
+    try:
+        submitted = 0
+        next_seq = 0    # next batch to hand out
+        for batch in batched(items, batch_size):
+            while submitted - next_seq >= max_pending:
+                results = _collect(done, ready, next_seq, ordered, pool, pids, pending)
+                next_seq += 1
+                for result in results:
+                    yield result
+            if sys.version_info[0] >= 3:
+                errors = {'error_callback': partial(_failed, done, submitted)}
+            else:
+                errors = {}     # failed batches are found by polling pending
+            pending[submitted] = pool.apply_async(_run_batch, (func, submitted, batch), callback=done.put, **errors)
+            submitted += 1
+        while next_seq < submitted:
+            results = _collect(done, ready, next_seq, ordered, pool, pids, pending)
+            next_seq += 1
+            for result in results:
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _collect(done, ready, next_seq, ordered, pool, pids, pending):
+    """Wait for the next batch to hand out, buffering out of order ones"""
+    while True:
+        if ordered and next_seq in ready:
+            return ready.pop(next_seq)
+        # a timeout keeps the wait interruptible with Ctrl-C, and notices dead workers
+        try:
+            seq, results, error = done.get(timeout=_POLL_SECONDS)
+        except Empty:
+            if _worker_pids(pool) != pids:
+                raise RuntimeError('a worker process died (killed, or crashed in native code), '
+                                   'the batch it was converting is lost')
+            # Python 2 has no error callback, its failed batches only show in their AsyncResult
+            for seq, result in pending.items():
+                if result.ready() and not result.successful():
+                    try:
+                        result.get()
+                    except Exception as e:
+                        raise RuntimeError('worker failed on batch %d:\n%s' % (seq, _describe(e)))
+            continue
+        pending.pop(seq, None)
+        if error is not None:
+            raise RuntimeError('worker failed on batch %d:\n%s' % (seq, error))
+        if not ordered or seq == next_seq:
+            return results
+        ready[seq] = results
+
+
+def _worker_pids(pool):
+    """
+    Process ids of the live workers of a Pool.  The Pool replaces a dead worker
+     with a new one but never runs its task again, so a change means a lost batch.
+    """
+    return set(process.pid for process in pool._pool if process.exitcode is None)
+
+
+def convert_dump(source, workers=None, batch_size=DEFAULT_BATCH_SIZE, ordered=True,
+                 namespaces=None, keep_sections=False, keep_links=False, cache=None, cleaner=None,
+                 budget=None):
+    """
+    Convert a dump into plain text using several processes.
+    :param source: a path or a binary file object, optionally bz2/gzip compressed
+    :param workers: number of worker processes, defaults to the number of cores
+    :param batch_size: number of pages sent to a worker at once
+    :param ordered: keep dump order, otherwise pages come out as they are done
+    :param namespaces: if given, only pages in these namespace numbers are converted
+    :param keep_sections: passed on to compact()
+    :param keep_links: passed on to clean()
+    :param cache: optional wikimedia2text.cache.ParseCache, only the pages missing from it are converted
+    :param cleaner: the wikimedia2text.parser.Cleaner profile to clean with, it is
+        compiled once per worker process
+    :param budget: optional wikimedia2text.guard.Budget, the pages exceeding it are
+        converted by the linear fallback and reported to its on_exceeded callback
+        in this process
+    :return: a generator of (page_id, title, namespace, cleaned_text) Page tuples
+    """
+    return convert_pages(iter_raw_pages(source, namespaces), workers=workers, batch_size=batch_size,
+                         ordered=ordered, keep_sections=keep_sections, keep_links=keep_links, cache=cache,
+                         cleaner=cleaner, budget=budget)
+
+
+def convert_pages(pages, workers=None, batch_size=DEFAULT_BATCH_SIZE, ordered=True,
+                  keep_sections=False, keep_links=False, stats=False, cache=None, cleaner=None,
+                  budget=None):
+    """
+    Convert raw Page tuples into plain text using several processes.
+    See convert_dump() for the parameters.
+    :param stats: if true, yield (Page, PageStats) pairs, see wikimedia2text.stats
+    :param cache: optional ParseCache, only the pages missing from it are converted
+    """
+    if stats and budget is not None:
+        raise ValueError('stats profile the conversion, they cannot be combined with a budget')
+    func = partial(convert_page, keep_sections=keep_sections, keep_links=keep_links, stats=stats, cleaner=cleaner,
+                   budget=budget)
+    if cache is None:
+        results = imap_batches(func, pages, workers=workers, batch_size=batch_size, ordered=ordered)
+    elif stats:
+        raise ValueError('stats profile the conversion, they cannot be combined with a cache')
+    else:
+        results = _convert_cached(func, pages, cache, workers, batch_size, ordered, keep_sections, keep_links,
+                                  cleaner, budget is not None)
+    if budget is None:
+        return results
+    return _report_exceeded(results, budget.on_exceeded)
+
+
+def _report_exceeded(results, on_exceeded):
+    """Hand the pages exceeding the budget to on_exceeded, passing all the pages on"""
+    for page, reason in results:
+        if reason is not None and on_exceeded is not None:
+            on_exceeded(page, reason)
+        yield page
+
+
+def _convert_cached(func, pages, cache, workers, batch_size, ordered, keep_sections, keep_links, cleaner,
+                    budgeted=False):
+    """
+    convert_pages() through a cache.  Pages found in the cache stay in this
+     process, the workers only see their sequence number, which keeps them in
+     line with the converted pages in both ordered and unordered mode.
+    With a budget, (page, reason) pairs are handled and yielded, and the pages
+     converted by the fallback are not cached.
+    """
+    pending = {}    # seq -> (cache key, cached page or None)
+
+    def lookup():
+        for seq, page in enumerate(pages):
+            key = cache.key(page.text, keep_sections, keep_links, cleaner)
+            text = cache.get(key)
+            if text is None:
+                pending[seq] = key, None
+                yield seq, page
+            else:
+                pending[seq] = key, page._replace(text=text)
+                yield seq, None
+
+    for seq, converted in imap_batches(partial(_convert_missing, func), lookup(), workers=workers,
+                                       batch_size=batch_size, ordered=ordered):
+        key, cached = pending.pop(seq)
+        if converted is None:
+            yield (cached, None) if budgeted else cached
+            continue
+        page, reason = converted if budgeted else (converted, None)
+        if reason is None:
+            cache.put(key, page.text)
+        yield converted
+
+
+def _convert_missing(func, item):
+    seq, page = item
+    return seq, None if page is None else func(page)
@@ -0,0 +1,101 @@
+"""
+Instrumentation of the cleaning pipeline.
+
+Pass a PageStats to parse() or clean() to get the wall time, the text size
+ before and after, and the number of matches handled by every stage:
+
+    stats = PageStats()
+    text = parse(wikitext, stats=stats)
+    print(stats.report())
+
+A StatsCollector aggregates the stats of a whole run, keeping the slowest
+ pages and a bounded sample of every stage to estimate percentiles.  When no
+ stats object is given the pipeline runs without any bookkeeping.
+"""
+import heapq
+import random
+from collections import namedtuple
+
+
+StageStats = namedtuple('StageStats', ['stage', 'seconds', 'size_in', 'size_out', 'matches'])
+
+
+class PageStats(object):
+    """The cost of every stage for one page"""
+
+    def __init__(self):
+        self.stages = []
+
+    def record(self, stage, seconds, size_in, size_out, matches):
+        self.stages.append(StageStats(stage, seconds, size_in, size_out, matches))
+
+    @property
+    def seconds(self):
+        return sum(s.seconds for s in self.stages)
+
+    def report(self):
+        lines = ['%-12s %10s %10s %10s %8s' % ('stage', 'ms', 'in', 'out', 'matches')]
+        for s in self.stages:
+            lines.append('%-12s %10.3f %10d %10d %8d' % (s.stage, s.seconds * 1000, s.size_in, s.size_out, s.matches))
+        return '\n'.join(lines)
+
+
+class StatsCollector(object):
+    """
+    Aggregate PageStats over many pages.
+    :param slowest: number of slowest pages to remember
+    :param sample_size: number of timings kept per stage for the percentiles
+    """
+
+    def __init__(self, slowest=10, sample_size=10000):
+        self.slowest_count = slowest
+        self.sample_size = sample_size
+        self.pages = 0
+        self.seconds = {}       # stage -> total time
+        self.matches = {}       # stage -> total matches
+        self.samples = {}       # stage -> reservoir of timings
+        self._slowest = []      # heap of (seconds, order, key)
+        self._random = random.Random(0)
+
+    def add(self, key, stats):
+        """Account for the PageStats of the page identified by key (e.g. its title)"""
+        self.pages += 1
+        for s in stats.stages:
+            self.seconds[s.stage] = self.seconds.get(s.stage, 0.0) + s.seconds
+            self.matches[s.stage] = self.matches.get(s.stage, 0) + s.matches
+            sample = self.samples.setdefault(s.stage, [])
+            if len(sample) < self.sample_size:
+                sample.append(s.seconds)
+            else:
+                i = self._random.randint(0, self.pages - 1)
+                if i < self.sample_size:
+                    sample[i] = s.seconds
+        entry = (stats.seconds, self.pages, key)
+        if len(self._slowest) < self.slowest_count:
+            heapq.heappush(self._slowest, entry)
+        elif entry > self._slowest[0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        """The slowest pages as (seconds, key), slowest first"""
+        return [(seconds, key) for seconds, order, key in sorted(self._slowest, reverse=True)]
+
+    def percentile(self, stage, percent):
+        """Estimated time of a stage (in seconds) below which percent of the pages fall"""
+        sample = sorted(self.samples.get(stage, ()))
+        if not sample:
+            return None
+        return sample[min(len(sample) - 1, int(len(sample) * percent / 100.0))]
+
+    def report(self, percents=(50, 90, 99)):
+        lines = ['%d pages' % self.pages,
+                 '%-12s %10s %8s %s' % ('stage', 'total s', 'matches',
+                                        ' '.join('%9s' % ('p%d ms' % p) for p in percents))]
+        for stage in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            lines.append('%-12s %10.3f %8d %s' % (
+                stage, self.seconds[stage], self.matches[stage],
+                ' '.join('%9.3f' % (self.percentile(stage, p) * 1000) for p in percents)))
+        lines.append('slowest pages:')
+        for seconds, key in self.slowest():
+            lines.append('%10.3f ms  %s' % (seconds * 1000, key))
+        return '\n'.join(lines)
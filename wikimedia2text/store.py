@@ -0,0 +1,279 @@
+"""
+Random access to converted pages by title or id.
+
+A store is a directory of shards and an index.  The texts are appended to the
+ shards in blocks of about block_size bytes, each compressed on its own, so
+ that reading a page only decompresses its block.  The index lists every page
+ sorted by title, and the pages with an id sorted by id, in fixed size records
+ searched by bisection on a memory map of the file:
+
+    writer = StoreWriter('enwiki.store')
+    for page in convert_dump('enwiki-pages-articles.xml.bz2'):
+        writer.add(page)
+    writer.close()
+
+    store = StoreReader('enwiki.store')
+    text = store.get(u'Anarchism')
+    text = store.get_id(12)
+
+The command line writes stores with --format store, and
+    python -m wikimedia2text.store STORE TITLE...
+prints pages from one.
+
+Index layout (little endian): a header (MAGIC, number of pages, number of
+ ids), the pages sorted by the utf-8 bytes of their title (ENTRY), the ids in
+ ascending order with the position of their page (ID_ENTRY), then the titles.
+"""
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import zlib
+
+from wikimedia2text.parser import decode_utf8, encode_utf8
+
+
+MAGIC = b'W2TSTORE'
+
+# Uncompressed size of the blocks, the unit of decompression
+DEFAULT_BLOCK_SIZE = 1 << 18
+
+# Compressed size above which a new shard is started
+DEFAULT_SHARD_SIZE = 1 << 30
+
+HEADER = struct.Struct('<8sQQ')
+# page id (-1 if none), shard, block offset, block length, offset in the block,
+# text length, title offset, title length
+ENTRY = struct.Struct('<qIQIIIQI')
+# page id, position of its ENTRY
+ID_ENTRY = struct.Struct('<qQ')
+
+INDEX_NAME = 'index'
+SHARD_NAME = 'shard-%05d'
+
+
+class StoreWriter(object):
+    """
+    Write converted pages to a new store.
+    :param path: the store directory, created if needed; an existing store in it is replaced
+    :param block_size: uncompressed size of the blocks compressed together
+    :param shard_size: size of a shard above which the next one is started
+    :param level: zlib compression level
+    """
+
+    def __init__(self, path, block_size=DEFAULT_BLOCK_SIZE, shard_size=DEFAULT_SHARD_SIZE, level=6):
+        self.path = path
+        self.block_size = block_size
+        self.shard_size = shard_size
+        self.level = level
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in os.listdir(path):
+            if name == INDEX_NAME or name.startswith(SHARD_NAME[:6]):
+                os.remove(os.path.join(path, name))
+        self.pages = 0
+        self._shard = -1
+        self._out = None
+        self._block = []        # texts of the block being filled
+        self._block_size = 0
+        self._block_pages = []  # (page id, title, offset in the block, length) of its pages
+        # the entries are sorted by sqlite, on disk rather than in memory
+        self._sort_path = os.path.join(path, INDEX_NAME + '.tmp')
+        if os.path.exists(self._sort_path):
+            os.remove(self._sort_path)
+        self._db = sqlite3.connect(self._sort_path)
+        self._db.execute('CREATE TABLE pages (title BLOB NOT NULL, id INTEGER, shard INTEGER, block INTEGER, '
+                         'block_length INTEGER, offset INTEGER, length INTEGER)')
+
+    def add(self, page):
+        """Add a converted Page (id, title, namespace, text)"""
+        text = encode_utf8(page.text)
+        self._block_pages.append((page.id, encode_utf8(page.title), self._block_size, len(text)))
+        self._block.append(text)
+        self._block_size += len(text)
+        self.pages += 1
+        if self._block_size >= self.block_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._block_pages:
+            return
+        if self._out is None or self._out.tell() >= self.shard_size:
+            if self._out is not None:
+                self._out.close()
+            self._shard += 1
+            self._out = open(os.path.join(self.path, SHARD_NAME % self._shard), 'wb')
+        data = zlib.compress(b''.join(self._block), self.level)
+        offset = self._out.tell()
+        self._out.write(data)
+        self._db.executemany('INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)', [
+            (sqlite3.Binary(title), page_id, self._shard, offset, len(data), start, length)
+            for page_id, title, start, length in self._block_pages])
+        self._block = []
+        self._block_size = 0
+        self._block_pages = []
+
+    def close(self):
+        """Write the last block and the index"""
+        self._flush()
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+        self._db.commit()
+        try:
+            self._write_index()
+        finally:
+            self._db.close()
+            os.remove(self._sort_path)
+
+    def _write_index(self):
+        db = self._db
+        count = db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+        ids = db.execute('SELECT COUNT(*) FROM pages WHERE id IS NOT NULL').fetchone()[0]
+        db.execute('CREATE TABLE ids (id INTEGER, position INTEGER)')
+        titles_at = HEADER.size + count * ENTRY.size + ids * ID_ENTRY.size
+        with open(os.path.join(self.path, INDEX_NAME), 'wb') as index:
+            index.write(HEADER.pack(MAGIC, count, ids))
+            titles = []
+            title_offset = titles_at
+            rows = db.execute('SELECT title, id, shard, block, block_length, offset, length FROM pages '
+                              'ORDER BY title, rowid')
+            for position, (title, page_id, shard, block, block_length, offset, length) in enumerate(rows):
+                title = bytes(title)
+                index.write(ENTRY.pack(-1 if page_id is None else page_id, shard, block, block_length,
+                                       offset, length, title_offset, len(title)))
+                titles.append(title)
+                title_offset += len(title)
+                if page_id is not None:
+                    db.execute('INSERT INTO ids VALUES (?, ?)', (page_id, position))
+                if len(titles) >= 1 << 16:
+                    self._spill(titles)
+            for page_id, position in db.execute('SELECT id, position FROM ids ORDER BY id, position'):
+                index.write(ID_ENTRY.pack(page_id, position))
+            # the titles, spilled to a side file so that they follow the ids
+            self._spill(titles)
+            spill = self._sort_path + '.titles'
+            if os.path.exists(spill):
+                with open(spill, 'rb') as f:
+                    while True:
+                        chunk = f.read(1 << 20)
+                        if not chunk:
+                            break
+                        index.write(chunk)
+                os.remove(spill)
+
+    def _spill(self, titles):
+        if titles:
+            with open(self._sort_path + '.titles', 'ab') as f:
+                f.write(b''.join(titles))
+            del titles[:]
+
+
+class StoreReader(object):
+    """
+    Read pages from a store in O(log n), decompressing a single block.
+    :param path: the store directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'rb') as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count, self._ids = HEADER.unpack_from(self._index, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a wikimedia2text store' % path)
+        self._ids_at = HEADER.size + self._count * ENTRY.size
+        self._shards = {}       # shard number -> mmap
+        self._block = None      # (shard, offset) and data of the last block read
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(self._index, HEADER.size + position * ENTRY.size)
+
+    def _title(self, entry):
+        return self._index[entry[6]:entry[6] + entry[7]]
+
+    def get(self, title):
+        """The text of the page titled title, or None"""
+        key = encode_utf8(title)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._title(self._entry(middle)) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count:
+            entry = self._entry(low)
+            if self._title(entry) == key:
+                return self._text(entry)
+        return None
+
+    def get_id(self, page_id):
+        """The text of the page with this id, or None"""
+        low, high = 0, self._ids
+        while low < high:
+            middle = (low + high) // 2
+            if ID_ENTRY.unpack_from(self._index, self._ids_at + middle * ID_ENTRY.size)[0] < page_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._ids:
+            found, position = ID_ENTRY.unpack_from(self._index, self._ids_at + low * ID_ENTRY.size)
+            if found == page_id:
+                return self._text(self._entry(position))
+        return None
+
+    def _text(self, entry):
+        page_id, shard, block, block_length, offset, length = entry[:6]
+        if self._block is None or self._block[0] != (shard, block):
+            data = self._shard(shard)[block:block + block_length]
+            self._block = (shard, block), zlib.decompress(data)
+        return decode_utf8(self._block[1][offset:offset + length])
+
+    def _shard(self, number):
+        shard = self._shards.get(number)
+        if shard is None:
+            with open(os.path.join(self.path, SHARD_NAME % number), 'rb') as f:
+                shard = self._shards[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return shard
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = {}
+        self._index.close()
+
+
+def main(argv=None):
+    """Print the pages named on the command line, by title or #id"""
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        sys.stderr.write('usage: python -m wikimedia2text.store STORE TITLE|#ID...\n')
+        return 2
+    store = StoreReader(argv[0])
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    status = 0
+    try:
+        for name in argv[1:]:
+            if isinstance(name, bytes):
+                name = name.decode('utf-8')
+            if name.startswith(u'#') and name[1:].isdigit():
+                text = store.get_id(int(name[1:]))
+            else:
+                text = store.get(name)
+            if text is None:
+                sys.stderr.write('%s: not found\n' % encode_utf8(name).decode('ascii', 'replace'))
+                status = 1
+            else:
+                out.write(encode_utf8(text) + b'\n')
+    finally:
+        store.close()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())